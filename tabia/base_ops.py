@@ -1,4 +1,3 @@
-import duckdb
 from .table import Table
 
 
@@ -13,6 +12,7 @@ def select(table, condition):
     Returns:
         duckdb.Table: A new table with the selected rows.
     """
+    import duckdb
     data = table.data
     return Table(duckdb.sql(f"SELECT * FROM data WHERE {condition}"))
 
@@ -24,6 +24,7 @@ def _normalise_columns(rel):
     for t1 * t2, n should be 1 and 2, while for a matching with already renamed columns m (with 1 and 2),
     t1 * m should result in 1 2 and 3. (i.e. 1 and 2 renamed to 2 and 3) and 1 inserted.
     """
+    import duckdb
     ncols = len(rel.columns)
     if ncols % 3 != 0:
         raise ValueError("Relation must have a column count that is a multiple of 3.")
@@ -45,6 +46,7 @@ def product(table1, table2):
     Returns:
         duckdb.Table: A new table that is the Cartesian product of the two input tables.
     """
+    import duckdb
     data1 = table1.data
     data2 = table2.data
     rel = duckdb.sql(f"SELECT COLUMNS(d1.*) AS 'l_\\0', COLUMNS(d2.*) AS 'r_\\0' FROM data1 d1 CROSS JOIN data2 d2")
@@ -63,6 +65,7 @@ def union(table1, table2):
     Returns:
         duckdb.Table: A new table that is the union of the two input tables.
     """
+    import duckdb
     data1 = table1.data
     data2 = table2.data
     rel = duckdb.sql(f"SELECT * FROM data1 UNION ALL SELECT * FROM data2")
@@ -80,6 +83,7 @@ def intersect(table1, table2):
     Returns:
         duckdb.Table: A new table that is the intersection of the two input tables.
     """
+    import duckdb
     rel = duckdb.sql(f"SELECT * FROM {table1.data} INTERSECT SELECT * FROM {table2.data}")
     return Table(rel)
 
@@ -95,6 +99,7 @@ def difference(table1, table2):
     Returns:
         duckdb.Table: A new table that contains rows from the first table that are not in the second.
     """
+    import duckdb
     data1 = table1.data
     data2 = table2.data
     rel = duckdb.sql(f"SELECT * FROM data1 EXCEPT SELECT * FROM data2")
@@ -112,6 +117,7 @@ def project(table, columns):
     Returns:
         duckdb.Table: A new table with only the specified columns.
     """
+    import duckdb
     data = table.data
     rel = duckdb.sql(f"SELECT distinct {', '.join(columns)} FROM data")
     rel = _normalise_columns(rel)
@@ -1,4 +1,3 @@
-import duckdb
 from .base_ops import select, project, union, difference, product, intersect
 
 
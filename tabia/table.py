@@ -1,8 +1,8 @@
-import pandas as pd
-import duckdb
+# pandas and duckdb are imported where they are used, importing tabia stays cheap
 
 
 def list_to_ijv(table, start=0, skip_none=False):
+    import pandas as pd
     rows = [
         (i + start, j + start, v)
         for i, row in enumerate(table)
@@ -13,6 +13,7 @@ def list_to_ijv(table, start=0, skip_none=False):
 
 
 def df_to_ijv(df, start=0, skip_na=False):
+    import pandas as pd
     a = df.to_numpy()
     rows = [(i + start, j + start, a[i, j])
             for i in range(a.shape[0]) for j in range(a.shape[1])
@@ -20,7 +21,7 @@ def df_to_ijv(df, start=0, skip_na=False):
     return pd.DataFrame(rows, columns=["i", "j", "v"])
 
 
-def ijv_to_df(ijv: pd.DataFrame, fill_value=None) -> pd.DataFrame:
+def ijv_to_df(ijv: "pd.DataFrame", fill_value=None) -> "pd.DataFrame":
     i0, j0 = ijv["i"].min(), ijv["j"].min()
     M = (ijv.assign(i=ijv["i"] - i0, j=ijv["j"] - j0)
          .pivot_table(index="i", columns="j", values="v", aggfunc="last")
@@ -32,7 +33,7 @@ def ijv_to_df(ijv: pd.DataFrame, fill_value=None) -> pd.DataFrame:
     return M
 
 
-def ijv_to_lists(ijv: pd.DataFrame, fill_value=None, start=None):
+def ijv_to_lists(ijv: "pd.DataFrame", fill_value=None, start=None):
     if ijv.empty:
         return []
     if start is None:
@@ -53,6 +54,8 @@ class Table:
     """
 
     def __init__(self, data):
+        import duckdb
+        import pandas as pd
         if isinstance(data, list):
             self.data = list_to_ijv(data, skip_none=True)
         elif isinstance(data, pd.DataFrame):
@@ -153,4 +153,12 @@ def test_join_rows():
 def test_fill1():
     a = Table([['desc', 'a'], [None, 'b']])
     b = fill1(a)
-    assert b.to_list() == [['desc', 'a'], ['desc', 'b'], [None, 'b']]
\ No newline at end of file
+    assert b.to_list() == [['desc', 'a'], ['desc', 'b'], [None, 'b']]
+
+
+def test_lazy_import():
+    import subprocess
+    import sys
+    code = "import sys, tabia.operations; print(sorted({'pandas', 'duckdb'} & set(sys.modules)))"
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
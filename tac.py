@@ -1,48 +1,225 @@
 import argparse
+import os
 
-from tacomin.build_vocab import main as build_vocab_main
-from tacomin.compare import main as compare_main
-from tacomin.search import main as search_main
-from tacomin.compress import main as compress_main
-from tacomin import compress
-from tacomin import refine
+from tacomin import telemetry
+from tacomin.pipeline import Pipeline, Stage
+
+# The commands import their modules when they run, so a single command only loads
+# the heavy dependencies (pandas, scipy, duckdb, xlrd) it uses
+
+
+def run_archive(args):
+    from tacomin import archive
+    archive.pack(input_tarfile=args.input_tar, archive_file=args.archive, sample_rate=args.sample_rate)
+
+
+def run_vocab(args):
+    from tacomin.build_vocab import main as build_vocab_main
+    build_vocab_main(input_file=args.input_tar, output_data_file=args.output_data, output_meta_file=args.output_meta, counts_only=args.counts_only, dedupe=not args.no_dedupe,
+                     sample_rate=args.sample_rate)
+
+
+def run_extract(args):
+    from tacomin.extract import main as extract_main
+    extract_main(input_file=args.input_tar, output_data_file=args.output_data, output_meta_file=args.output_meta, output_tall_dir=args.parquet_tall_dir, dedupe=not args.no_dedupe,
+                 sample_rate=args.sample_rate)
+
+
+def run_compare(args):
+    from tacomin.compare import main as compare_main
+    compare_main(infile=args.output_data, outfile=args.output_top, limit=None, top_k=args.compare_k,
+                 method=args.compare_method, num_perm=args.lsh_perm, bands=args.lsh_bands,
+                 max_bucket=args.lsh_max_bucket, recall_sample=args.recall_sample, n_jobs=args.n_jobs,
+                 block_size=args.block_size, shard_size=args.shard_size, sample_rate=args.sample_rate)
+
+
+def run_search(args):
+    from tacomin.search import main as search_main
+    search_main(x_file=args.output_data, top_file=args.output_top.format(k=args.compare_k), output_tripples=args.output_tripples, n_jobs=args.n_jobs,
+                top_n=args.top_n, per_anchor=args.per_anchor, min_score=args.min_score,
+                metrics=args.metrics.split(','), score=args.score_metric, sample_rate=args.sample_rate)
+
+
+def run_rescore(args):
+    from tacomin import score
+    score.rescore(tripples=args.output_tripples, output_tripples=args.output_rescored, metrics=args.metrics.split(','),
+                  score=args.score_metric, top_n=args.top_n)
+
+
+def run_components(args):
+    from tacomin import compress
+    compress.components_stream(tripples=args.output_tripples, output_file=args.output_components, n_top=args.components_top)
+
+
+def input_tars(args):
+    """The tars holding the members of the corpus, the ingest tar after the input tar."""
+    return [args.input_tar] + ([args.ingest_tar] if args.ingest_tar else [])
+
+
+def run_compress(args):
+    from tacomin.compress import main as compress_main
+    compress_main(input_tarfile=input_tars(args), meta_file=args.output_meta, tripples=args.output_tripples, output_tarfile=args.top_tar,
+                  archive_file=args.archive if args.use_archive else None, sample_rate=args.sample_rate)
+
+
+def run_parquet(args):
+    from tacomin import compress
+    compress.to_parquet(input_tarfile=args.top_tar, metadata_file=args.output_meta, output_dir=args.parquet_tall_dir,
+                        sample_rate=args.sample_rate)
+
+
+def run_tall(args):
+    from tacomin import compress
+    compress.to_tall(input_parquet_dir=args.parquet_dir or args.parquet_tall_dir, output_parquet_dir=args.parquet_tall_dir,
+                     sheets_per_file=args.sheets_per_file, n_jobs=args.n_jobs)
+
+
+def run_index(args):
+    from tacomin import index
+    index.build(parquet_tall_dir=args.parquet_tall_dir, index_file=args.index_file)
+
+
+def run_fingerprint(args):
+    from tacomin import fingerprint
+    fingerprint.build(parquet_tall_dir=args.parquet_tall_dir, fingerprint_dir=args.fingerprint_dir, kind=args.fingerprint_kind, n_jobs=args.n_jobs)
+
+
+def run_refine(args):
+    from tacomin import refine
+    refine.main(x_file=args.output_data, top_file=args.output_top, parquet_tall_dir=args.parquet_tall_dir, n_contains=args.n_contains, n_move_size=args.n_move_size, top_k=args.compare_k,
+                moves_dir=args.moves_dir, n_jobs=args.n_jobs, max_df=args.max_df,
+                max_value_cells=args.max_value_cells, weight_moves=args.weight_moves,
+                index_file=args.index_file if args.use_index else None,
+                fingerprint_dir=args.fingerprint_dir if args.move_method == 'fingerprints' else None,
+                sample_rate=args.sample_rate)
+
+
+def stages(args):
+    """The pipeline stages with the artifacts they read and write, and the arguments they depend on."""
+    top_file = args.output_top.format(k=args.compare_k)
+    # tall reclusters the parquet output in place, and marks that by writing the manifest,
+    # so the stages that read the tall cells depend on the manifest
+    tall_manifest = os.path.join(args.parquet_tall_dir, 'manifest.parquet')
+    tall_inputs = [tall_manifest]
+    if args.use_index:
+        tall_inputs.append(args.index_file)
+    if args.move_method == 'fingerprints':
+        tall_inputs.append(args.fingerprint_dir)
+
+    def stage(name, inputs, outputs, params):
+        return Stage(name, lambda: COMMANDS[name](args), inputs, outputs, {p: getattr(args, p) for p in params})
+
+    return [
+        stage('archive', [args.input_tar], [args.archive], ['sample_rate']),
+        stage('vocab', [args.input_tar], [args.output_data, args.output_meta], ['counts_only', 'no_dedupe', 'sample_rate']),
+        stage('compare', [args.output_data], [top_file],
+              ['compare_k', 'compare_method', 'lsh_perm', 'lsh_bands', 'lsh_max_bucket', 'block_size', 'shard_size']),
+        stage('search', [args.output_data, top_file], [args.output_tripples],
+              ['top_n', 'per_anchor', 'min_score', 'metrics', 'score_metric']),
+        stage('components', [args.output_tripples], [args.output_components], ['components_top']),
+        stage('compress', input_tars(args) + [args.output_meta, args.output_tripples] + ([args.archive] if args.use_archive else []),
+              [args.top_tar], ['sample_rate']),
+        stage('parquet', [args.top_tar, args.output_meta], [args.parquet_tall_dir], ['sample_rate']),
+        stage('tall', [args.parquet_dir or args.parquet_tall_dir], [tall_manifest], ['sheets_per_file']),
+        stage('index', [tall_manifest], [args.index_file], []),
+        stage('fingerprint', [tall_manifest], [args.fingerprint_dir], ['fingerprint_kind']),
+        stage('refine', [args.output_data, top_file] + tall_inputs, [args.moves_dir],
+              ['compare_k', 'n_contains', 'n_move_size', 'max_df', 'max_value_cells', 'weight_moves', 'move_method']),
+        stage('verify', [args.output_tripples, tall_manifest], [args.verify_output], ['verify_top']),
+    ]
+
+
+def run_run(args):
+    pipeline = Pipeline(stages(args), stamp_dir=args.stamp_dir)
+    force = args.force.split(',') if args.force else ()
+    pipeline.run(args.targets.split(','), force=force, n_jobs=args.n_jobs)
+
+
+def run_verify(args):
+    from tacomin import verify
+    verify.main(tripples=args.output_tripples, parquet_tall_dir=args.parquet_tall_dir, output_file=args.verify_output,
+                top_n=args.verify_top, n_jobs=args.n_jobs)
+
+
+def run_ingest(args):
+    from tacomin import ingest
+    ingest.main(input_file=args.ingest_tar, data_file=args.output_data, meta_file=args.output_meta, top_file=args.output_top,
+                tripples=args.output_tripples, top_k=args.compare_k, dedupe=not args.no_dedupe, top_n=args.top_n,
+                metrics=args.metrics.split(','), score=args.score_metric, sample_rate=args.sample_rate)
+    # The stages after search read the appended artifacts, so the next run redoes them
+    pipeline = Pipeline(stages(args), stamp_dir=args.stamp_dir)
+    pipeline.invalidate(pipeline.downstream('search'))
+
+
+def run_report(args):
+    telemetry.report(args.telemetry_file, run=args.run_id, base=args.base_run)
+
+
+COMMANDS = {name[len('run_'):]: command for name, command in list(globals().items()) if name.startswith('run_')}
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Tacomin')
     parser.add_argument(
         'command', type=str, help='Command to run',
-        choices=['vocab', 'compare', 'search', 'compress', 'parquet', 'tall', 'refine']
+        choices=['run', 'archive', 'vocab', 'extract', 'compare', 'search', 'rescore', 'components', 'compress', 'parquet', 'tall', 'index', 'fingerprint', 'refine', 'verify', 'ingest', 'report']
     )
     parser.add_argument('--input-tar', type=str, help='Input file', default='~/Downloads/fuse-binaries-dec2014.tar.gz')
+    parser.add_argument('--ingest-tar', type=str, help='Tar with new sheets to append to the corpus with ingest, and to read members from in later runs', default=None)
+    parser.add_argument('--archive', type=str, help='Seekable archive of the input tar members', default='experiments/results/members.zar')
+    parser.add_argument('--use-archive', action='store_true', help='Read members from the archive instead of streaming the input tar')
     parser.add_argument('--output-data', type=str, help='Output data file', default='experiments/results/data.npz')
     parser.add_argument('--output-meta', type=str, help='Output data file', default='experiments/results/meta.pkl')
-    parser.add_argument('--counts-only', type=bool, help='Do not build the vocab', default='False')
+    parser.add_argument('--counts-only', action='store_true', help='Do not build the vocab')
     parser.add_argument('--output-top', type=str, help='Top file', default='experiments/results/top{k}.npz')
     parser.add_argument('--compare-k', type=int, help='Top k', default=20)
+    parser.add_argument('--compare-method', type=str, help='Exact all pairs or MinHash/LSH candidates', choices=['exact', 'lsh', 'outofcore'], default='exact')
+    parser.add_argument('--lsh-perm', type=int, help='Number of MinHash permutations', default=64)
+    parser.add_argument('--lsh-bands', type=int, help='Number of LSH bands, more bands give higher recall', default=16)
+    parser.add_argument('--lsh-max-bucket', type=int, help='Maximum number of sheets paired within one LSH bucket', default=50)
+    parser.add_argument('--recall-sample', type=int, help='Number of sheets to measure LSH recall on', default=1000)
+    parser.add_argument('--n-jobs', type=int, help='Number of worker threads, defaults to the number of cores', default=None)
+    parser.add_argument('--block-size', type=int, help='Rows per out-of-core compare block', default=10_000)
+    parser.add_argument('--shard-size', type=int, help='Rows per out-of-core compare shard', default=100_000)
     parser.add_argument('--output-tripples', type=str, help='Tripples file', default='experiments/results/ftripples.parquet')
+    parser.add_argument('--output-rescored', type=str, help='Triples file of rescore, by default next to the triples file', default=None)
+    parser.add_argument('--top-n', type=int, help='Only keep this number of best triples (all by default)', default=None)
+    parser.add_argument('--per-anchor', type=int, help='Number of best triples to keep per anchor sheet', default=None)
+    parser.add_argument('--min-score', type=float, help='Only keep triples scoring above this', default=None)
+    parser.add_argument('--metrics', type=str, help='Comma separated triple metrics, of geo_area, geo_count, geo_count_norm, pct_area', default='geo_area')
+    parser.add_argument('--score-metric', type=str, help='Metric to rank triples by, defaults to the first metric', default=None)
+    parser.add_argument('--output-components', type=str, help='Best triple per component', default='experiments/results/components.parquet')
+    parser.add_argument('--components-top', type=int, help='Only use the best n triples by score for the components', default=None)
     parser.add_argument('--top-tar', type=str, help='Top tar file', default='experiments/results/filtered2.tar.gz')
-    parser.add_argument('--parquet-dir', type=str, help='Parquet directory', default='experiments/results/parquet2')
+    parser.add_argument('--parquet-dir', type=str, help='Input parquet directory of tall, by default the tall directory itself', default=None)
     parser.add_argument('--parquet-tall-dir', type=str, help='Parquet directory', default='experiments/results/parquet_tall')
+    parser.add_argument('--sheets-per-file', type=int, help='Sheets per clustered tall parquet file', default=1000)
+    parser.add_argument('--index-file', type=str, help='Index database of the tall parquet', default='experiments/results/index.duckdb')
+    parser.add_argument('--use-index', action='store_true', help='Read cells from the index database in refine')
+    parser.add_argument('--fingerprint-dir', type=str, help='Fingerprint parquet directory', default='experiments/results/fingerprints')
+    parser.add_argument('--fingerprint-kind', type=str, help='Cells hashed per fingerprint', choices=['block', 'row'], default='block')
+    parser.add_argument('--move-method', type=str, help='Find moves from equal cell values or shared fingerprints', choices=['cells', 'fingerprints'], default='cells')
+    parser.add_argument('--verify-output', type=str, help='Reconstruction category per triple', default='experiments/results/verified.parquet')
+    parser.add_argument('--verify-top', type=int, help='Only verify the best n triples', default=None)
     parser.add_argument('--n-contains', type=int, help='Number of contains', default=5)
     parser.add_argument('--n-move-size', type=int, help='Number of move size', default=5)
+    parser.add_argument('--moves-dir', type=str, help='Moves parquet directory', default='experiments/results/moves')
+    parser.add_argument('--max-df', type=float, help='Skip values in more sheets than this (a fraction if below 1) when finding moves', default=None)
+    parser.add_argument('--max-value-cells', type=int, help='Skip values that fill more cells of a sheet than this when finding moves', default=None)
+    parser.add_argument('--weight-moves', action='store_true', help='Weight move votes by the idf of the value')
+    parser.add_argument('--targets', type=str, help='Comma separated stages to bring up to date with run', default='refine')
+    parser.add_argument('--force', type=str, help='Comma separated stages to rerun even if up to date', default=None)
+    parser.add_argument('--stamp-dir', type=str, help='Directory of the stage stamps of run', default='experiments/results/.tac')
+    parser.add_argument('--telemetry-file', type=str, help='JSONL file to append stage timings and resource use to', default='experiments/results/telemetry.jsonl')
+    parser.add_argument('--run-id', type=str, help='Run to tag telemetry with, or to report on (the last run by default)', default=None)
+    parser.add_argument('--base-run', type=str, help="Run to compare the report to, or 'previous'", default=None)
+    parser.add_argument('--sample-rate', type=float, help='Only use this fraction of the members, chosen by a hash of their name', default=None)
+    parser.add_argument('--no-dedupe', action='store_true', help='Keep duplicate members and sheets')
 
     args = parser.parse_args()
-    if args.command == 'vocab':
-        build_vocab_main(input_file=args.input_tar, output_data_file=args.output_data, output_meta_file=args.output_meta, counts_only=bool(args.counts_only))
-    elif args.command == 'compare':
-        compare_main(infile=args.output_data, outfile=args.output_top, limit=None, top_k=args.compare_k)
-    elif args.command == 'search':
-        search_main(x_file=args.output_data, top_file=args.output_top, output_tripples=args.output_tripples)
-    elif args.command == 'compress':
-        compress_main(input_tarfile=args.input_tar, meta_file=args.output_meta, tripples=args.output_tripples, output_tarfile=args.top_tar)
-    elif args.command == 'parquet':
-        compress.to_parquet(input_tarfile=args.top_tar, metadata_file=args.output_meta, output_dir=args.parquet_dir)
-    elif args.command == 'tall':
-        compress.to_tall(input_parquet_dir=args.parquet_dir, output_parquet_dir=args.parquet_tall_dir)
-    elif args.command == 'refine':
-        refine.main(x_file=args.output_data, top_file=args.output_top, parquet_tall_dir=args.parquet_tall_dir, n_contains=args.n_contains, n_move_size=args.n_move_size, top_k=args.compare_k)
-
-
-
-
+    if args.command == 'report':
+        run_report(args)
+    else:
+        telemetry.configure(args.telemetry_file, run=args.run_id)
+        with telemetry.span(args.command):
+            COMMANDS[args.command](args)
@@ -0,0 +1,80 @@
+import io
+import tarfile
+import time
+import zlib
+
+import pandas as pd
+from tqdm import tqdm
+
+from .sample import in_sample
+
+
+def index_file(archive_file):
+    return archive_file + '.index.parquet'
+
+
+def pack(input_tarfile, archive_file, level=6, sample_rate=None):
+    """
+    Repack the file members of a (compressed) tar into a seekable archive: every member is
+    zlib compressed on its own and appended to archive_file, and the member name, offset
+    and sizes go to the index next to it. This is one full pass over the tar; afterwards
+    any member can be read without decompressing the ones before it. With a sample_rate
+    only the members in the sample are packed.
+    """
+    t0 = time.time()
+    rows = []
+    offset = 0
+    with tarfile.open(input_tarfile, mode='r|*') as tar_stream, open(archive_file, 'wb') as out:
+        for member in tqdm(tar_stream):
+            if not member.isfile() or not in_sample(member.name, sample_rate):
+                continue
+            data = zlib.compress(tar_stream.extractfile(member).read(), level)
+            out.write(data)
+            rows.append((member.name, member.name.split('/')[-1], offset, len(data), member.size, member.mtime))
+            offset += len(data)
+    df = pd.DataFrame(rows, columns=['name', 'filename', 'offset', 'compressed_size', 'size', 'mtime'])
+    df.to_parquet(index_file(archive_file))
+    print('Members', len(df), 'size', df['size'].sum(), 'compressed', offset)
+    print('Time taken', time.time() - t0)
+
+
+class Archive:
+    """
+    Read members of an archive written by pack, by tar name or by file name (the last part
+    of the tar name, as in the meta file).
+    """
+
+    def __init__(self, archive_file):
+        self.archive_file = archive_file
+        self.index = pd.read_parquet(index_file(archive_file))
+        self.locations = {}
+        for row in self.index.itertuples(index=False):
+            self.locations[row.name] = self.locations[row.filename] = row
+        self.file = open(archive_file, 'rb')
+
+    def __contains__(self, name):
+        return name in self.locations
+
+    def member(self, name):
+        """The TarInfo of a member, for writing it to another tar."""
+        row = self.locations[name]
+        info = tarfile.TarInfo(row.name)
+        info.size = row.size
+        info.mtime = row.mtime
+        return info
+
+    def read(self, name):
+        row = self.locations[name]
+        self.file.seek(row.offset)
+        return zlib.decompress(self.file.read(row.compressed_size))
+
+    def read_fs(self, fs, words_member):
+        """The bytes of the workbook of sheet fs, and the sheet number within it."""
+        filename, sheetnr = words_member[fs]
+        return self.read(filename), sheetnr
+
+    def extractfile(self, name):
+        return io.BytesIO(self.read(name))
+
+    def close(self):
+        self.file.close()
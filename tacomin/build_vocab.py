@@ -1,24 +1,39 @@
 import io
+import numpy as np
 from scipy.sparse import save_npz
-from pickle import dump
+from pickle import dump, load
 import tarfile
 import pandas as pd
 from scipy.sparse import csr_matrix
 import time
-from tqdm import tqdm
 
 from xlrd.compdoc import CompDocError
 
+from .corpus import corpus_dir, save_corpus
+from .dedupe import Deduplicator
+from .sample import estimate, in_sample
+from . import telemetry
+
+# Rows read per sheet by every stage. pandas infers the dtype of a column from the rows
+# read, so a stage that read fewer rows could encode the same cell differently ('1' or '1.0')
+NROWS = 10_000
+
 # Suppress warning for xlrd
 import warnings
 # Filter all warning that start with "WARNING"
 warnings.filterwarnings('ignore')
 
 
-def load_from_tar(tar, counts_only=False):
-    vocab = {}
+def load_from_tar(tar, counts_only=False, dedupe=True, vocab=None, skip=(), sample_rate=None, dedup=None, first_fs=0):
+    """Parse the sheets of a tar stream into sorted arrays of vocab ids. An existing vocab is
+    extended in place, and members whose file name is in skip or that are not in the sample
+    (see sample.in_sample) are not read. To extend a corpus, pass the Deduplicator seeded
+    with its hashes and its number of rows as first_fs, the row of the first new sheet."""
+    vocab = {} if vocab is None else vocab
     words_member = []
     words = []
+    dedup = Deduplicator() if dedup is None else dedup
+    num_duplicates = 0
     t0 = time.time()
     total_time_open = 0
     icounter = 0
@@ -29,13 +44,14 @@ def load_from_tar(tar, counts_only=False):
     num_sheets = 0
     for _, member in enumerate(tar):
         t0_loop = time.time()
-        if icounter > 1_000_000:
-            break
-        if not member.isfile():
+        if not member.isfile() or member.name.split('/')[-1] in skip or not in_sample(member.name, sample_rate):
             continue
         try:
-            buffer = tar.extractfile(member)
-            dfs = pd.read_excel(io.BytesIO(buffer.read()), sheet_name=None, header=None, index_col=None, nrows=10000)
+            data = tar.extractfile(member).read()
+            if dedupe and dedup.is_duplicate_member(member.name, data):
+                num_duplicates += 1
+                continue
+            dfs = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None, index_col=None, nrows=NROWS)
             t1 = time.time()
             total_time_open += t1 - t0_loop
         except CompDocError:
@@ -56,6 +72,9 @@ def load_from_tar(tar, counts_only=False):
                 num_cropped_tables += 1
             vals = {}
             if not counts_only:
+                if dedupe and dedup.canonical_sheet(member.name, dfi, df, first_fs + len(words)) is not None:
+                    num_duplicates += 1
+                    continue
                 # Iterate over all cells
                 vals = {str(v)[:20] for v in df.values[:100, :100].flatten()}
                 # Update vocab
@@ -63,8 +82,8 @@ def load_from_tar(tar, counts_only=False):
                 # Add new words to vocab
                 vocab.update({v: vocab_size + i for i, v in
                               enumerate(val[:20] if isinstance(val, str) else val for val in vals if val not in vocab)})
-                # Update words
-                words.append({vocab[v[:20] if isinstance(v, str) else v] for v in vals})
+                # Update words, as a sorted array of ids
+                words.append(np.unique(np.fromiter((vocab[v] for v in vals), dtype=np.int32, count=len(vals))))
                 words_member.append((member, dfi))
             t2 = time.time()
             total_time = (t2 - t0)
@@ -81,61 +100,94 @@ def load_from_tar(tar, counts_only=False):
     items_per_second = icounter / (t2 - t0)
     print(f'{icounter}', f'{items_per_second:.1f}', f'{percentage_open:.2%}',
           '  ', len(vocab), cell_counter, cell_counter_cropped, num_files, num_sheets, num_cropped_tables)
+    print('Duplicates skipped', num_duplicates)
     print()
-    return vocab, words_member, words
+    telemetry.record(items=icounter, parse=total_time_open, files=num_files, duplicates=num_duplicates, vocab=len(vocab))
+    return vocab, words_member, words, dedup.duplicates
 
 
 def pack(words_member, words):
-    indptr = [0]
-    indices = []
-    data = []
-    vocabulary = {}
-    for name, sheet in tqdm(zip(words_member, words)):
-        indices.extend(list(sheet))
-        data.extend([1] * len(sheet))
-        indptr.append(len(indices))
-    x = csr_matrix((data, indices, indptr), dtype=int)
+    """Pack the per-sheet arrays of sorted ids into a CSR matrix with int32 indices
+    (int64 only when the number of entries needs it) and uint8 data."""
+    indptr = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(sheet) for sheet in words], out=indptr[1:])
+    nnz = indptr[-1].item()
+    indices = np.empty(nnz, dtype=np.int32)
+    if words:
+        np.concatenate(words, out=indices)
+    if nnz < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    data = np.ones(nnz, dtype=np.uint8)
+    n_cols = indices.max() + 1 if nnz else 0
+    x = csr_matrix((data, indices, indptr), shape=(len(words), n_cols), copy=False)
+    x.has_sorted_indices = True
     return x
 
 
-def save(x, vocab, words_member, output_data_file, output_meta_file):
+def save(x, vocab, words_member, output_data_file, output_meta_file, duplicates=None, hashes=None):
     print('Saving data')
     save_npz(output_data_file, x)
+    save_corpus(x, corpus_dir(output_data_file))
     # Save the vocab
     print('Saving meta')
-    with open(output_meta_file, 'wb') as f:
-        dump((vocab, [(w.name.split('/')[-1], snr) for w, snr in words_member]), f)
+    save_meta(vocab, [(w.name.split('/')[-1], snr) for w, snr in words_member], output_meta_file, duplicates, hashes)
     print('Done')
 
 
+def save_meta(vocab, words_member, output_meta_file, duplicates=None, hashes=None):
+    """Save the vocab, the (file name, sheet nr) of every row, the duplicate map and the
+    member and sheet hashes of the Deduplicator (see Deduplicator.hashes)."""
+    with open(output_meta_file, 'wb') as f:
+        dump((vocab, words_member, duplicates or {}, hashes), f)
+
+
+def load_meta(meta_file, with_hashes=False):
+    """Load (vocab, words_member, duplicates) from a meta file, and the hashes too with
+    with_hashes. The duplicate map, from (member, sheet nr) to the fs of the canonical
+    sheet, is empty for older meta files, and the hashes are None."""
+    with open(meta_file, 'rb') as f:
+        meta = tuple(load(f))
+    meta = meta + ({}, None)[len(meta) - 2:]
+    return meta if with_hashes else meta[:3]
+
+
 def main(
         input_file='~/Downloads/fuse-binaries-dec2014.tar.gz',
         output_data_file='experiments/results/data.npz',
         output_meta_file='experiments/results/meta.pkl',
         counts_only=False,
+        dedupe=True,
+        sample_rate=None,
 ):
     t0 = time.time()
     # pass over all files and build summary
     file = input_file
     tar_stream = tarfile.open(file, mode='r|*')
-    vocab, words_member, words = load_from_tar(tar_stream, counts_only=counts_only)
+    with telemetry.span('vocab', 'load'):
+        dedup = Deduplicator()
+        vocab, words_member, words, duplicates = load_from_tar(tar_stream, counts_only=counts_only, dedupe=dedupe,
+                                                                sample_rate=sample_rate, dedup=dedup)
+        t1 = time.time()
+        estimate('vocab', len(words), t1 - t0, sample_rate)
     print('vocab size', len(vocab))
     print('words size', len(words))
     print('words_member size', len(words_member))
-    t1 = time.time()
     print('Time taken', t1 - t0)
     if counts_only:
         print('Counts only')
         return
 
     print('Packing')
-    x = pack(words_member, words)
+    with telemetry.span('vocab', 'pack') as span:
+        x = pack(words_member, words)
+        span.items = x.nnz
     print('x shape', x.shape)
     t2 = time.time()
     print('Time taken', t2 - t1)
 
     # Save to disk
-    save(x, vocab, words_member, output_data_file, output_meta_file)
+    with telemetry.span('vocab', 'save'):
+        save(x, vocab, words_member, output_data_file, output_meta_file, duplicates, dedup.hashes() if dedupe else None)
     t3 = time.time()
     print('Time taken', t3 - t2)
     print('Total time taken', t3 - t0)
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class TopCollector:
+    """
+    Keep the highest scoring rows of a stream of DataFrames in bounded memory.
+
+    - min_score drops rows with a score at or below it.
+    - per_anchor keeps the best rows per value of the anchor column. Batches must hold
+      disjoint anchors, as the blocks of search and refine do.
+    - n keeps the best n rows overall. The buffer is cut back to n rows whenever it grows
+      past 2n, and later rows below the n-th best score are dropped on arrival.
+
+    Without n, the kept rows are final as soon as a batch is added and are appended to
+    output_file as a row group right away. With n, output_file is written, sorted by
+    score, on close.
+    """
+
+    def __init__(self, output_file=None, n=None, per_anchor=None, min_score=None, anchor='i', score='score'):
+        self.output_file = output_file
+        self.n = n
+        self.per_anchor = per_anchor
+        self.min_score = min_score
+        self.anchor = anchor
+        self.score = score
+        self.threshold = -np.inf
+        self.buffer = []
+        self.buffered = 0
+        self.writer = None
+        self.empty = None
+        self.count = 0
+
+    def add(self, df):
+        self.count += len(df)
+        if self.empty is None:
+            self.empty = df.iloc[:0]
+        if self.min_score is not None:
+            df = df[df[self.score] > self.min_score]
+        if self.per_anchor is not None:
+            df = df.sort_values(self.score, ascending=False, kind='stable').groupby(self.anchor, sort=False).head(self.per_anchor)
+        if self.n is None:
+            self.write(df)
+            return
+        df = df[df[self.score] >= self.threshold]
+        self.buffer.append(df)
+        self.buffered += len(df)
+        if self.buffered > 2 * self.n:
+            self.prune()
+
+    def prune(self):
+        df = pd.concat(self.buffer, ignore_index=True)
+        if len(df) > self.n:
+            df = df.iloc[np.argpartition(-df[self.score].to_numpy(), self.n - 1)[:self.n]]
+            self.threshold = df[self.score].min()
+        self.buffer = [df]
+        self.buffered = len(df)
+
+    def write(self, df):
+        if self.output_file is None:
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_file, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        """Write the remaining rows and return the best n rows sorted by score (None without n)."""
+        top = None
+        if self.n is not None and self.buffer:
+            self.prune()
+            top = self.buffer[0].sort_values(self.score, ascending=False, ignore_index=True)
+            self.write(top)
+        if self.writer is None and self.empty is not None:
+            self.write(self.empty)
+        if self.writer is not None:
+            self.writer.close()
+        return top
@@ -1,30 +1,36 @@
+import json
+import os
+import shutil
 import numpy as np
 import time
-from scipy.sparse import load_npz
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+from .corpus import open_corpus
+from .lsh import minhash_signatures, candidate_pairs
+from .sample import estimate
+from . import telemetry
 
-def csr_topk_rows(csr_matrix, k):
-    n_rows = csr_matrix.shape[0]
-    topk_indices = np.full((n_rows, k), -1, dtype=np.int32)
 
-    for i in range(n_rows):
-        start, end = csr_matrix.indptr[i], csr_matrix.indptr[i + 1]
-        row_data = csr_matrix.data[start:end]
-        row_indices = csr_matrix.indices[start:end]
-        if len(row_data) > k:
-            topk_indices[i, :k] = row_indices[np.argpartition(row_data, k)[:k]]
-        else:
-            topk_indices[i, :len(row_data)] = row_indices[np.argsort(row_data)]
-
-    return topk_indices
+def topk_segments(rows, cols, scores, n_rows, k):
+    """
+    Keep the k columns with the largest score per row from unordered (row, col, score)
+    triples, as (n_rows, k) arrays of columns and scores in descending order of score.
+    Rows with fewer than k entries are padded with -1 and 0.
+    """
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+    top = np.full((n_rows, k), -1, dtype=np.int32)
+    top_scores = np.zeros((n_rows, k), dtype=np.float32)
+    top[rows[keep], rank[keep]] = cols[keep]
+    top_scores[rows[keep], rank[keep]] = scores[keep]
+    return top, top_scores
 
 
-def main(infile='experiments/results/data.npz', outfile='experiments/results/top20.npz', limit=None, top_k=20):
-    # Load from disk
-    x = load_npz(infile)
-
-    t0 = time.time()
+def tfidf(x):
+    """Boolean tf-idf weights, over the tokens that occur in more than one sheet."""
     # Select columns where sum is larger than 1
     cols = np.where(x.sum(axis=0) > 1)[1]
     xd = x[:, cols]
@@ -36,29 +42,218 @@ def main(infile='experiments/results/data.npz', outfile='experiments/results/top
     N = xdc.shape[1]
     idf = np.log(N / xdc.sum(axis=0))
     print('divide', idf.shape)
-    xd = xd.multiply(idf)
+    xd = xd.multiply(idf).tocsr()
     print('done', xd.shape)
+    return xd
 
-    # Get the top 20 columns for each row
+
+def exact_topk(xd, rows, k, xdt=None):
+    """Exact top k most similar other sheets for the given rows."""
+    xdt = xd.T.tocsr() if xdt is None else xdt
+    dots = (xd[rows] @ xdt).tocoo()
+    keep = rows[dots.row] != dots.col
+    return topk_segments(dots.row[keep], dots.col[keep], dots.data[keep], len(rows), k)
+
+
+def blocked_topk(xd, k, chunksize=1000, n_jobs=None, limit=None):
+    """
+    Exact top k for all rows, computing the dot products one block of rows at a time.
+
+    Blocks run on a thread pool (the sparse product and sorts release the GIL), and each
+    block is reduced to its top k as soon as it is done, so at most n_jobs blocks of dot
+    products are in memory at once.
+    """
+    n_rows = min(limit, xd.shape[0]) if limit else xd.shape[0]
+    xdt = xd.T.tocsr()
+    top = np.full((n_rows, k), -1, dtype=np.int32)
+    top_scores = np.zeros((n_rows, k), dtype=np.float32)
+
+    def block(start):
+        rows = np.arange(start, min(start + chunksize, n_rows))
+        top[rows], top_scores[rows] = exact_topk(xd, rows, k, xdt)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        list(tqdm(pool.map(block, range(0, n_rows, chunksize)), total=-(-n_rows // chunksize)))
+    return top, top_scores
+
+
+def lsh_topk(xd, k, num_perm=64, bands=16, max_bucket=50, pair_chunksize=1_000_000):
+    """Approximate top k: MinHash/LSH candidate pairs, rescored with the exact tf-idf dot product.
+    More bands (of fewer rows) and larger buckets increase recall at the cost of more candidates."""
+    print('minhash', num_perm)
+    sig = minhash_signatures(xd, num_perm=num_perm)
+    rows, cols = candidate_pairs(sig, bands=bands, max_bucket=max_bucket)
+    print('candidates', len(rows), f'{len(rows) / max(xd.shape[0], 1):.1f} per sheet')
+    scores = np.empty(len(rows), dtype=np.float32)
+    for i in tqdm(range(0, len(rows), pair_chunksize)):
+        r, c = rows[i:i + pair_chunksize], cols[i:i + pair_chunksize]
+        scores[i:i + pair_chunksize] = np.asarray(xd[r].multiply(xd[c]).sum(axis=1)).ravel()
+    keep = scores > 0
+    return topk_segments(rows[keep], cols[keep], scores[keep], xd.shape[0], k)
+
+
+def idf_weights(df):
+    """The tfidf() weight per token from the document frequencies, zero for tokens in only one sheet."""
+    keep = df > 1
+    weights = np.zeros(len(df), dtype=np.float32)
+    weights[keep] = np.log(keep.sum() / df[keep])
+    return weights
+
+
+def open_block_array(path, shape, dtype, fill):
+    """Open an on-disk array of a previous run to resume it, or create it."""
+    if os.path.exists(path):
+        arr = np.load(path, mmap_mode='r+')
+        if arr.shape != shape:
+            raise ValueError(f'{path} has shape {arr.shape}, expected {shape}; remove it to start over')
+        return arr
+    arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    arr[:] = fill
+    return arr
+
+
+def blocks_dir(top_file):
+    """The working directory of outofcore_topk for a top file."""
+    return os.path.splitext(top_file)[0] + '_blocks'
+
+
+def blocks_key(corpus, k, block_size, shard_size):
+    """What the blocks in a working directory were computed from: the corpus, identified by
+    its shape, number of tokens and the modification time of its indices, and the settings."""
+    mtime = os.stat(os.path.join(corpus.directory, 'indices.npy')).st_mtime_ns
+    return {'shape': list(corpus.shape), 'nnz': int(corpus.indptr[-1]), 'mtime': mtime,
+            'k': k, 'block_size': block_size, 'shard_size': shard_size}
+
+
+def outofcore_topk(corpus, k, workdir, block_size=10_000, shard_size=100_000, n_jobs=None):
+    """
+    Exact top k over a memory mapped Corpus.
+
+    Each block of rows is weighted on the fly and multiplied with one shard of rows at a
+    time, merging the top k after every shard, so peak memory is set by block_size x
+    shard_size. The results go to top.npy and scores.npy in workdir as each block finishes,
+    and done.npy marks the finished blocks, so an interrupted run continues where it stopped.
+    key.json holds blocks_key of the run; when it does not match the workdir starts over.
+    """
+    n_rows = corpus.shape[0]
+    key = blocks_key(corpus, k, block_size, shard_size)
+    key_file = os.path.join(workdir, 'key.json')
+    if os.path.exists(workdir):
+        previous = None
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                previous = json.load(f)
+        if previous != key:
+            print('Blocks in', workdir, 'are of another corpus or settings, starting over')
+            shutil.rmtree(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    with open(key_file, 'w') as f:
+        json.dump(key, f)
+    weights = idf_weights(corpus.document_frequencies())
+    n_blocks = -(-n_rows // block_size)
+    top = open_block_array(os.path.join(workdir, 'top.npy'), (n_rows, k), np.int32, -1)
+    top_scores = open_block_array(os.path.join(workdir, 'scores.npy'), (n_rows, k), np.float32, 0)
+    done = open_block_array(os.path.join(workdir, 'done.npy'), (n_blocks,), np.bool_, False)
+    print('Blocks done', done.sum(), 'of', n_blocks)
+
+    def block(b):
+        if done[b]:
+            return
+        start, stop = b * block_size, min((b + 1) * block_size, n_rows)
+        xb = corpus.block(start, stop, weights)
+        t = np.full((stop - start, k), -1, dtype=np.int32)
+        ts = np.zeros((stop - start, k), dtype=np.float32)
+        for s in range(0, n_rows, shard_size):
+            dots = (xb @ corpus.block(s, min(s + shard_size, n_rows), weights).T).tocoo()
+            rows, cols = np.nonzero(t >= 0)
+            keep = dots.row + start != dots.col + s
+            t, ts = topk_segments(
+                np.concatenate([rows, dots.row[keep]]),
+                np.concatenate([t[rows, cols], dots.col[keep] + s]),
+                np.concatenate([ts[rows, cols], dots.data[keep]]),
+                stop - start, k)
+        top[start:stop], top_scores[start:stop] = t, ts
+        top.flush()
+        top_scores.flush()
+        done[b] = True
+        done.flush()
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        list(tqdm(pool.map(block, range(n_blocks)), total=n_blocks))
+    return top, top_scores
+
+
+def recall(xd, top, k, sample=1000, seed=0):
+    """Fraction of the exact top k neighbours found in `top`, on a sample of rows."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(xd.shape[0], size=min(sample, xd.shape[0]), replace=False)
+    exact, _ = exact_topk(xd, rows, k)
+    found = total = 0
+    for approx_row, exact_row in zip(top[rows], exact):
+        exact_row = exact_row[exact_row >= 0]
+        found += len(np.intersect1d(approx_row, exact_row))
+        total += len(exact_row)
+    return found / total if total else 1.0
+
+
+def main(infile='experiments/results/data.npz', outfile='experiments/results/top20.npz', limit=None, top_k=20,
+         method='exact', num_perm=64, bands=16, max_bucket=50, recall_sample=1000, n_jobs=None,
+         block_size=10_000, shard_size=100_000, sample_rate=None):
+    """Top k most similar sheets per sheet. With the sample_rate the corpus was sampled at,
+    the time of the full corpus is estimated, quadratic in the sheets apart from lsh.
+    limit, the number of sheets to find neighbours for, only applies to the exact method."""
+    if method == 'lsh' and not 0 < bands <= num_perm:
+        raise ValueError(f'bands must be between 1 and num_perm ({num_perm}), got {bands}')
+    if limit is not None and method != 'exact':
+        raise ValueError(f'limit is only supported by the exact method, not {method}')
     k = top_k
-    xdl = xd.tolil()
-    xdc = xd.T.tocsc()
-
-    chunksize = 1000
-    topks = []
-    for i in tqdm(range(xdl.shape[0])[::chunksize]):
-        if limit and i >= limit:
-            break
-        dots = np.dot(xdl[i:i+chunksize, :], xdc)
-        args = csr_topk_rows(dots, k)
-        topks.append(args)
-
-    top = np.concat(topks)
+    if method == 'outofcore':
+        t0 = time.time()
+        workdir = blocks_dir(outfile.format(k=top_k))
+        corpus = open_corpus(infile)
+        with telemetry.span('compare', 'topk', method=method) as span:
+            top, top_scores = outofcore_topk(corpus, k, workdir, block_size=block_size, shard_size=shard_size, n_jobs=n_jobs)
+            span.items = top.shape[0]
+            estimate('compare', top.shape[0], time.time() - t0, sample_rate, power=2)
+        print('Top shape', top.shape)
+        print('Time taken', time.time() - t0)
+        with telemetry.span('compare', 'save'):
+            np.savez_compressed(outfile.format(k=top_k), top=top, scores=top_scores, df=corpus.document_frequencies())
+        del top, top_scores
+        shutil.rmtree(workdir)
+        return
+
+    # Load from disk
+    with telemetry.span('compare', 'load') as span:
+        corpus = open_corpus(infile)
+        x = corpus.matrix()
+        span.items = x.shape[0]
+
+    t0 = time.time()
+    xd = tfidf(x)
+
+    # Get the top 20 columns for each row
+    with telemetry.span('compare', 'topk', method=method) as span:
+        if method == 'lsh':
+            top, top_scores = lsh_topk(xd, k, num_perm=num_perm, bands=bands, max_bucket=max_bucket)
+        else:
+            top, top_scores = blocked_topk(xd, k, n_jobs=n_jobs, limit=limit)
+        span.items = top.shape[0]
+        estimate('compare', top.shape[0], time.time() - t0, sample_rate, power=1 if method == 'lsh' else 2)
     t1 = time.time()
+    if method == 'lsh' and recall_sample:
+        with telemetry.span('compare', 'recall') as span:
+            r = recall(xd, top, k, sample=recall_sample)
+            span.items = recall_sample
+            telemetry.record(recall=r)
+        print(f'Recall@{k} on {recall_sample} sheets', f'{r:.2%}')
     print('Top shape', top.shape)
     print('Time taken', t1 - t0)
-    np.savez_compressed(outfile.format(k=top_k), top=top)
+    # The document frequencies are kept for the value pruning in refine
+    with telemetry.span('compare', 'save'):
+        df = corpus.document_frequencies()
+        np.savez_compressed(outfile.format(k=top_k), top=top, scores=top_scores, df=df)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,26 +1,36 @@
 import os
 import glob
 import io
-import pandas as pd
-import pickle
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import tarfile
 from tqdm import tqdm
-from pickle import load
-from scipy.sparse import coo_matrix
-from scipy.sparse.csgraph import connected_components
 
+from .sample import estimate, in_sample
+from . import telemetry
 
-def main(input_tarfile, meta_file, tripples, output_tarfile):
+# pandas, pyarrow, duckdb and the modules that parse workbooks are imported by the
+# functions that use them, so a command only loads what it needs (see tac.py)
+
+
+def main(input_tarfile, meta_file, tripples, output_tarfile, archive_file=None, sample_rate=None):
     # Iterate through the tar file and build another tar file with only the
-    # tripples mentioned in the output_tripples file
+    # tripples mentioned in the output_tripples file. With an archive (see archive.pack)
+    # only the wanted members are read. input_tarfile can also be a list of tars, as
+    # after ingest the members of the corpus are in more than one.
+    import pandas as pd
+    from .archive import Archive
+    from .build_vocab import load_meta
+    input_tarfiles = [input_tarfile] if isinstance(input_tarfile, str) else list(input_tarfile)
 
     # Load the tripples
     tripples = pd.read_parquet(tripples)
     ftripples = tripples[tripples.score > 0]
 
     # Load the meta file
-    with open(meta_file, 'rb') as f:
-        vocab, words_member = load(f)
+    vocab, words_member, duplicates = load_meta(meta_file)
 
     # Create a set of used indices
     used_indices = {i for i in ftripples['i'].values} | {i for i in ftripples['j'].values} | {i for i in ftripples['k'].values}
@@ -29,122 +39,216 @@ def main(input_tarfile, meta_file, tripples, output_tarfile):
     # Create a set of tar names to save
     tar_names = {filename for i, (filename, sheetnr) in enumerate(words_member) if i in used_indices}
     print('Tar names', len(tar_names))
-
-    # Open the tar file in stream mode, and open the output tar file also in stream mode
-    with tarfile.open(input_tarfile, mode='r|*') as tar_stream, tarfile.open(output_tarfile, mode='w|') as output_tar_stream:
-        for i, tar_info in enumerate(tqdm(tar_stream)):
-            if tar_info.name.split('/')[-1] in tar_names:
-                output_tar_stream.addfile(tar_info, tar_stream.extractfile(tar_info))
+    telemetry.record(items=len(tar_names), sheets=len(used_indices))
+
+    with tarfile.open(output_tarfile, mode='w|') as output_tar_stream:
+        if archive_file is not None:
+            archive = Archive(archive_file)
+            for filename in tqdm(sorted(n for n in tar_names if n in archive)):
+                output_tar_stream.addfile(archive.member(filename), archive.extractfile(filename))
+            # Members appended by ingest are not in the archive, they are streamed from their tar
+            tar_names = {n for n in tar_names if n not in archive}
+            archive.close()
+
+        # Open the tar files in stream mode, every member is written once
+        for input_tarfile in input_tarfiles:
+            if not tar_names:
+                break
+            with tarfile.open(input_tarfile, mode='r|*') as tar_stream:
+                for i, tar_info in enumerate(tqdm(tar_stream)):
+                    # Members outside the sample are never in the meta file, skipping them only saves the lookup
+                    if in_sample(tar_info.name, sample_rate) and tar_info.name.split('/')[-1] in tar_names:
+                        output_tar_stream.addfile(tar_info, tar_stream.extractfile(tar_info))
+                        tar_names.discard(tar_info.name.split('/')[-1])
 
     print('Done')
 
 
-def components(df, n_top=1000):
-    """Remove similar sheets from the top n_top sheets by only
-    keeping the highest scoring sheet per connected component"""
-
-    # Create the three edge sets from each 3-clique
-    edges_ij = df[['i', 'j']]
-    edges_ik = df[['i', 'k']].rename(columns={'k': 'j'})
-    edges_jk = df[['j', 'k']].rename(columns={'j': 'i', 'k': 'j'})
-
-    # Concatenate all edges into one DataFrame
-    edges = pd.concat([edges_ij, edges_ik, edges_jk], ignore_index=True)
+def find(parent, nodes):
+    """The roots of nodes in the union-find forest parent, compressing their paths."""
+    roots = parent[nodes]
+    while True:
+        up = parent[roots]
+        if (up == roots).all():
+            break
+        roots = up
+    parent[nodes] = roots
+    return roots
 
-    # For an undirected graph, ensure symmetry by adding the reversed pairs
-    edges_sym = pd.concat([edges, edges.rename(columns={'i': 'j', 'j': 'i'})], ignore_index=True)
 
-    # Extract row and column indices for the sparse matrix
-    rows = edges_sym['i']
-    cols = edges_sym['j']
+def union(parent, a, b):
+    """Merge the sets of every pair (a[n], b[n]), always linking the larger root to the smaller
+    one. Every root is linked to its smallest partner in a round, so a hub with many
+    partners links them all at once, and rounds repeat until all pairs agree."""
+    while len(a):
+        ra, rb = find(parent, a), find(parent, b)
+        differ = ra != rb
+        a, b, ra, rb = a[differ], b[differ], ra[differ], rb[differ]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
 
-    # Determine the total number of nodes. Here we assume nodes are 0-indexed.
-    n_nodes = df[['i', 'j', 'k']].max().max() + 1
 
-    # Build the sparse adjacency matrix
-    data = [1] * len(rows)
-    adjacency_matrix = coo_matrix((data, (rows, cols)), shape=(n_nodes, n_nodes))
+def grow(parent, n):
+    """Extend parent with singleton nodes up to n nodes."""
+    if n <= len(parent):
+        return parent
+    return np.concatenate([parent, np.arange(len(parent), n, dtype=parent.dtype)])
 
-    # Compute the connected components
-    n_components, labels = connected_components(adjacency_matrix, directed=False)
 
-    print("Number of connected components:", n_components)
-    print("Component labels for each node:", labels)
-    df['component'] = [labels[i].item() for i in df.i]
+def components(df, n_top=1000):
+    """Remove similar sheets from the top n_top sheets by only
+    keeping the highest scoring sheet per connected component"""
+    # Sheets of a triple are connected, the component is the smallest sheet id in it
+    i, j, k = (df[c].to_numpy(dtype=np.int64) for c in ['i', 'j', 'k'])
+    parent = grow(np.zeros(0, dtype=np.int64), max(i.max(), j.max(), k.max()) + 1)
+    union(parent, i, j)
+    union(parent, i, k)
+    df['component'] = find(parent, i)
+    print("Number of components:", len(np.unique(df.component)))
 
     # Now get the highest scoring row per component
-    dfc = df.head(n_top).groupby('component').apply(lambda x: x.loc[x.score.idxmax()]).sort_values('score', ascending=False)
+    head = df.head(n_top)
+    dfc = head.loc[head.groupby('component').score.idxmax()].sort_values('score', ascending=False)
     return dfc
 
 
-def to_parquet(input_tarfile, metadata_file, output_dir):
+def score_threshold(parquet_file, n, batch_size=1_000_000):
+    """The score of the n-th best triple of a triples file, and how many of the best n have
+    that score, from its score column alone. Memory is set by n, not the number of triples."""
+    best = np.zeros(0)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['score']):
+        best = np.concatenate([best, batch.column('score').to_numpy()])
+        if len(best) > n:
+            best = np.partition(best, len(best) - n)[len(best) - n:]
+    threshold = best.min()
+    return threshold, n - int((best > threshold).sum())
+
+
+def components_stream(tripples, output_file, labelled_file=None, n_top=None, batch_size=1_000_000):
+    """
+    components() for a whole triples file in bounded memory.
+
+    The first pass streams the (i, j, k) columns of the best n_top triples by score (all by
+    default) into a union-find over sheet ids; the file does not have to be sorted, and ties
+    at the n_top-th score are taken in file order. The second pass labels those triples with
+    their component and keeps the best scoring triple per component, so memory is set by the
+    number of sheets and components, not triples. The best triples go to output_file, sorted
+    by score, and with labelled_file all used triples are also written there with their
+    component.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    t0 = time.time()
+    parquet_file = pq.ParquetFile(tripples)
+    select = None
+    if n_top is not None and n_top < parquet_file.metadata.num_rows:
+        threshold, n_ties = score_threshold(parquet_file, n_top, batch_size)
+
+        def select(score, ties):
+            """The rows of a batch among the best n_top, and the ties still to take after it."""
+            mask = score > threshold
+            tie = np.flatnonzero(score == threshold)[:ties]
+            mask[tie] = True
+            return mask, ties - len(tie)
+
+    parent = np.zeros(0, dtype=np.int64)
+    ties = n_ties if select else 0
+    for batch in tqdm(parquet_file.iter_batches(batch_size=batch_size, columns=['i', 'j', 'k', 'score'])):
+        i, j, k = (batch.column(c).to_numpy().astype(np.int64) for c in ['i', 'j', 'k'])
+        if select:
+            mask, ties = select(batch.column('score').to_numpy(), ties)
+            i, j, k = i[mask], j[mask], k[mask]
+        if not len(i):
+            continue
+        parent = grow(parent, max(i.max(), j.max(), k.max()) + 1)
+        union(parent, i, j)
+        union(parent, i, k)
+    labels = find(parent, np.arange(len(parent)))
+    print('Number of components:', len(np.unique(labels)))
+
+    best = None
+    writer = None
+    seen = 0
+    ties = n_ties if select else 0
+    for batch in tqdm(parquet_file.iter_batches(batch_size=batch_size)):
+        df = batch.to_pandas()
+        if select:
+            mask, ties = select(df.score.to_numpy(), ties)
+            df = df[mask]
+        seen += len(df)
+        df['component'] = labels[df.i.to_numpy()]
+        if labelled_file is not None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            writer = writer or pq.ParquetWriter(labelled_file, table.schema)
+            writer.write_table(table)
+        best = pd.concat([best, df]) if best is not None else df
+        best = best.sort_values('score', ascending=False, kind='stable').drop_duplicates('component')
+    if writer is not None:
+        writer.close()
+    if best is None:
+        # No triples, e.g. all below the min_score of search
+        best = parquet_file.schema_arrow.empty_table().to_pandas().assign(component=np.zeros(0, dtype=np.int64))
+    best.reset_index(drop=True).to_parquet(output_file)
+    telemetry.record(items=seen, components=len(best))
+    print('Components', len(best))
+    print('Time taken', time.time() - t0)
+    return best
+
+
+def to_parquet(input_tarfile, metadata_file, output_dir, sample_rate=None):
+    """
+    Write the sheets of the (filtered) tar in the tall (fs, i, j, v) layout, in files of
+    1000 sheets, with fs the row of the sheet in the token matrix and v the vocab id from
+    the meta file. Words that are not in that vocab get new ids after it. Sheets that are
+    not in the token matrix, duplicates or members outside the sample, are skipped.
+    """
+    import pandas as pd
+    from .build_vocab import NROWS, load_meta
+    from .extract import encode_sheet, write_tall
+    from .index import write_manifest
+    t0 = time.time()
     # Create output dir if not exists
     os.makedirs(output_dir, exist_ok=True)
 
-    with open(metadata_file, 'rb') as f:
-        vocab, words_member = pickle.load(f)
+    vocab, words_member, duplicates = load_meta(metadata_file)
     member_map = {member: i for i, member in enumerate(words_member)}
 
     tar_stream = tarfile.open(input_tarfile, mode='r|*')
-    vocab = {}
     icounter = 0
     total_counter = 0
+    total_time_open = 0
     df_list = []
     for member_number, member in enumerate(tar_stream):
-        if icounter > 1_000_001:
-            break
-        if not member.isfile():
+        if not member.isfile() or not in_sample(member.name, sample_rate):
             continue
+        t0_loop = time.time()
         try:
             buffer = tar_stream.extractfile(member)
-            dfs = pd.read_excel(io.BytesIO(buffer.read()), sheet_name=None, header=None, index_col=None, nrows=100)
+            dfs = pd.read_excel(io.BytesIO(buffer.read()), sheet_name=None, header=None, index_col=None, nrows=NROWS)
         except Exception as e:
             continue
+        total_time_open += time.time() - t0_loop
         for dfi, df in enumerate(dfs.values()):
-            # Iterate over all cells
-            vals = {str(v)[:20] for v in df.values[:100, :100].flatten()}
-            # Update vocab
-            vocab_size = len(vocab)
-            # Add new words to vocab
-            # 0 Is empty, 1 is Other (rare)
-            vocab.update({v: vocab_size + i + 2 for i, v in
-                          enumerate(val[:20] if isinstance(val, str) else val for val in vals if val not in vocab)})
-            # Make sure the df is 100 by 100
-            df_clipped = df.iloc[:100, :100]
-            df_padded = df_clipped
-            # ..also by adding empty cols if necessary
-            if df_clipped.shape[1] < 100:
-                df_padded = pd.concat([df_clipped, pd.DataFrame(columns=range(df_clipped.shape[1], 100))], axis=1)
-            # Map df to vocab - all ints
-            df_mapped = df_padded.map(lambda x: vocab[str(x)[:20]] if str(x)[:20] in vocab else 1)
-            df_mapped['f'] = member.name
-            df_mapped['s'] = dfi
-            df_mapped['fs'] = member_map[member.name.split('/')[-1], dfi]
-            df_mapped['rows'] = df_clipped.shape[0]
-            df_mapped['cols'] = df_clipped.shape[1]
-            # Add row index as column, excluding the index name
-            df_mapped.index.name = 'i'
-            df_mapped.reset_index(drop=False, inplace=True)
-
-            # Add to list
-            df_list.append(df_mapped)
+            # Skip duplicate sheets, they are not in the token matrix
+            if (member.name.split('/')[-1], dfi) not in member_map:
+                continue
+            i, j, v, _ = encode_sheet(df, vocab)
+            fs = member_map[member.name.split('/')[-1], dfi]
+            df_list.append(pd.DataFrame({'fs': np.full(len(v), fs, dtype=np.int32), 'i': i, 'j': j, 'v': v}))
 
             icounter += 1
 
             # Accumulate sheets and write to parquet
             if len(df_list) >= 1000:
-                dfc = pd.concat(df_list)
-                dfc.columns = dfc.columns.astype(str)
-                print(f'{icounter}', f'{total_counter}', '  ', len(dfs), len(vocab), dfc.shape)
-                dfc.to_parquet(f'{output_dir}/df_{total_counter:04d}.parquet', compression='zstd')
+                shape = write_tall(df_list, output_dir, total_counter)
+                print(f'{icounter}', f'{total_counter}', '  ', len(dfs), len(vocab), shape)
                 df_list = []
                 total_counter += 1
 
     # Save last batch
-    dfc = pd.concat(df_list)
-    dfc.columns = dfc.columns.astype(str)
-    print(f'{icounter}', f'{total_counter}', '  ', len(dfs), len(vocab), dfc.shape)
-    dfc.to_parquet(f'{output_dir}/df_{total_counter:04d}.parquet', compression='zstd')
+    if df_list:
+        shape = write_tall(df_list, output_dir, total_counter)
+        print(f'{icounter}', f'{total_counter}', '  ', len(vocab), shape)
 
     # Save vocab
     vocab_df = pd.DataFrame(vocab.items(), columns=['word', 'id'])
@@ -155,25 +259,109 @@ def to_parquet(input_tarfile, metadata_file, output_dir):
     dfm['index'] = dfm.index
     dfm['filename'] = dfm.word.apply(lambda x: f'cc-binaries/{x}')
     dfm.to_parquet(f'{output_dir}/words_member.parquet')
-
-
-def to_tall(input_parquet_dir, output_parquet_dir):
-    # Read the parquet files which have schema (f, fs, rows, cols, col1, col2, ...)
-    # And transform to parquet files with schema (fs, i, j, value)
-    # Read them one by one, because they cannot all fit into memory
-    # Create output dir if not exists
-    vocab = pd.read_parquet(os.path.join(input_parquet_dir, 'vocab.parquet'))
-    nan_index = vocab[vocab.word == 'nan'].id.values[0]
-
+    write_manifest(output_dir)
+    telemetry.record(items=icounter, parse=total_time_open)
+    estimate('parquet', icounter, time.time() - t0, sample_rate)
+
+
+def wide_to_tall(parquet_file, output_file, nan_index, threads=1):
+    """Unpivot one wide parquet file (f, s, fs, i, rows, cols, 0, ..., 99) of the old to_parquet
+    to the tall (fs, i, j, v) layout, dropping the empty cells."""
+    import duckdb
+    con = duckdb.connect(config={'threads': threads})
+    con.sql(f"""
+    copy (
+    select fs, i, cast(j as int) as j, v from (
+        unpivot (select fs, i, columns('^[0-9]+$') from '{parquet_file}')
+        on columns('^[0-9]+$') into name j value v
+    )
+    where v != {nan_index}
+    ) to '{output_file}' (format parquet)
+    """)
+    con.close()
+
+
+def cluster_tall(files, output_file, fs_min, fs_max, row_group_size=100_000, threads=1):
+    """Write the cells of sheets fs_min..fs_max from the tall files to one file, sorted by fs, i, j."""
+    import duckdb
+    con = duckdb.connect(config={'threads': threads})
+    con.sql(f"""
+    copy (
+    select cast(fs as int) as fs, cast(i as smallint) as i, cast(j as utinyint) as j, cast(v as int) as v
+    from read_parquet({files!r})
+    where fs between {fs_min} and {fs_max}
+    order by fs, i, j
+    ) to '{output_file}' (format parquet, compression zstd, row_group_size {row_group_size})
+    """)
+    con.close()
+
+
+def to_tall(input_parquet_dir, output_parquet_dir, sheets_per_file=1000, row_group_size=100_000, n_jobs=None):
+    """
+    Rewrite a parquet directory to tall (fs, i, j, v) files clustered by fs: file n holds
+    sheets n * sheets_per_file up to the next file, sorted by fs, i, j, in row groups of
+    row_group_size cells with min/max statistics. manifest.parquet maps the fs range of
+    every row group to its file (see index.tall_source). The input and output directory
+    can be the same, and the output files are only replaced once all input cells are
+    clustered.
+
+    The input can be tall, as to_parquet and extract write it, or wide, as the old
+    to_parquet wrote it, in which case the files are unpivoted first. Every step is a
+    DuckDB query per file, run in parallel.
+    """
+    import pandas as pd
+    import pyarrow.parquet as pq
+    from .index import row_groups, write_manifest
+    t0 = time.time()
+    parquet_files = sorted(glob.glob(os.path.join(input_parquet_dir, 'df_*.parquet')))
+    if not parquet_files:
+        raise ValueError(f'No df_*.parquet files in {input_parquet_dir}')
     os.makedirs(output_parquet_dir, exist_ok=True)
-    parquet_files = glob.glob(os.path.join(input_parquet_dir, 'df_*.parquet'))
-    for parquet_file in tqdm(parquet_files):
-        df = pd.read_parquet(parquet_file)
-        cols = [f'{i}' for i in range(100)]
-        dfp = df.set_index(['i', 'fs'])[cols]\
-            .stack().reset_index()\
-            .rename(columns={'level_2': 'j', 0: 'v'})[['fs', 'i', 'j', 'v']]
-        dfp = dfp[dfp.v != nan_index]
-        dfp = dfp.astype({'i': 'int16', 'fs': 'int32', 'j': 'uint8', 'v': 'int32'})
-        dfp.sort_values(['fs', 'i', 'j'], inplace=True)
-        dfp.to_parquet(os.path.join(output_parquet_dir, os.path.basename(parquet_file)), compression='zstd')
+    n_jobs = n_jobs or os.cpu_count()
+    threads = max(1, os.cpu_count() // n_jobs)
+    pool = ThreadPoolExecutor(max_workers=n_jobs)
+
+    tmp_dir = None
+    if 'v' not in pq.ParquetFile(parquet_files[0]).schema_arrow.names:
+        vocab = pd.read_parquet(os.path.join(input_parquet_dir, 'vocab.parquet'))
+        nan_index = vocab[vocab.word == 'nan'].id.values[0]
+        tmp_dir = os.path.join(output_parquet_dir, 'unpivot')
+        os.makedirs(tmp_dir, exist_ok=True)
+        outputs = [os.path.join(tmp_dir, os.path.basename(f)) for f in parquet_files]
+        print('Unpivot', len(parquet_files), 'files')
+        list(tqdm(pool.map(lambda f, o: wide_to_tall(f, o, nan_index, threads), parquet_files, outputs), total=len(outputs)))
+        parquet_files = outputs
+
+    # Clustered files go to a staging directory first, as the input can be the output
+    sources = row_groups(parquet_files)
+    stage_dir = os.path.join(output_parquet_dir, 'clustered')
+    os.makedirs(stage_dir, exist_ok=True)
+    buckets = []
+    for b in range(int(sources.fs_max.max()) // sheets_per_file + 1 if len(sources) else 0):
+        fs_min, fs_max = b * sheets_per_file, (b + 1) * sheets_per_file - 1
+        overlap = sources[(sources.fs_min <= fs_max) & (sources.fs_max >= fs_min)]
+        if len(overlap):
+            files = [os.path.join(os.path.dirname(parquet_files[0]), f) for f in overlap.file.unique()]
+            buckets.append((files, os.path.join(stage_dir, f'df_{b:04d}.parquet'), fs_min, fs_max))
+    print('Cluster', len(buckets), 'files')
+    list(tqdm(pool.map(lambda b: cluster_tall(*b, row_group_size=row_group_size, threads=threads), buckets), total=len(buckets)))
+    pool.shutdown()
+
+    # The old files are only replaced once the clustered ones hold every input cell
+    staged = row_groups(sorted(glob.glob(os.path.join(stage_dir, 'df_*.parquet'))))
+    if staged.num_rows.sum() != sources.num_rows.sum():
+        raise RuntimeError(f'Clustered {staged.num_rows.sum()} of {sources.num_rows.sum()} cells, '
+                           f'{output_parquet_dir} is left as it was')
+    for old in glob.glob(os.path.join(output_parquet_dir, 'df_*.parquet')):
+        os.remove(old)
+    for new in glob.glob(os.path.join(stage_dir, 'df_*.parquet')):
+        os.replace(new, os.path.join(output_parquet_dir, os.path.basename(new)))
+    shutil.rmtree(stage_dir)
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir)
+    for name in ['vocab.parquet', 'words_member.parquet']:
+        if os.path.exists(os.path.join(input_parquet_dir, name)) and \
+                not os.path.samefile(input_parquet_dir, output_parquet_dir):
+            shutil.copy(os.path.join(input_parquet_dir, name), output_parquet_dir)
+    write_manifest(output_parquet_dir)
+    print('Time taken', time.time() - t0)
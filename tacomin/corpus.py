@@ -0,0 +1,82 @@
+import json
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz
+
+
+def corpus_dir(data_file):
+    """The corpus directory that belongs to a data file, e.g. data.npz -> data/."""
+    return os.path.splitext(data_file)[0]
+
+
+def save_corpus(x, directory):
+    """Save the CSR arrays of the token matrix as raw .npy files that can be memory mapped.
+    The data array is not stored, since all entries are 1."""
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'indptr.npy'), x.indptr)
+    np.save(os.path.join(directory, 'indices.npy'), x.indices)
+    with open(os.path.join(directory, 'shape.json'), 'w') as f:
+        json.dump(list(x.shape), f)
+
+
+def npz_to_corpus(data_file):
+    """Convert a token matrix saved with save_npz to a corpus directory."""
+    save_corpus(load_npz(data_file).tocsr(), corpus_dir(data_file))
+
+
+def open_corpus(data_file):
+    """The Corpus of a data file, converted from the .npz on first use for data files
+    written before the corpus directory existed."""
+    directory = corpus_dir(data_file)
+    if not os.path.exists(os.path.join(directory, 'shape.json')):
+        print('Converting', data_file, 'to', directory)
+        npz_to_corpus(data_file)
+    return Corpus(directory)
+
+
+class Corpus:
+    """
+    The token matrix, memory mapped from a corpus directory.
+
+    Only the pages that are touched are read, and processes that map the same files share
+    them through the page cache. Rows and matrices handed out are views of the mapped
+    arrays, so threads and worker processes never copy the corpus.
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        self.directory = directory
+        self.indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode=mmap_mode)
+        self.indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(directory, 'shape.json')) as f:
+            self.shape = tuple(json.load(f))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def lengths(self):
+        """Number of tokens per sheet."""
+        return np.diff(self.indptr)
+
+    def matrix(self):
+        """The whole token matrix as a CSR matrix on top of the mapped indptr and indices.
+        Only the data, one byte per entry, is allocated."""
+        x = csr_matrix((np.ones(len(self.indices), dtype=np.uint8), self.indices, self.indptr),
+                       shape=self.shape, copy=False)
+        x.has_sorted_indices = True
+        return x
+
+    def block(self, start, stop, weights=None):
+        """Rows start:stop as an in-memory CSR matrix, with data weights[token] or 1."""
+        a, b = self.indptr[start], self.indptr[stop]
+        indices = np.asarray(self.indices[a:b])
+        indptr = np.asarray(self.indptr[start:stop + 1]) - a
+        data = weights[indices] if weights is not None else np.ones(len(indices), dtype=np.uint8)
+        return csr_matrix((data, indices, indptr), shape=(stop - start, self.shape[1]))
+
+    def document_frequencies(self, chunksize=100_000_000):
+        """Number of sheets per token, counted over chunks of the indices."""
+        counts = np.zeros(self.shape[1], dtype=np.int64)
+        for i in range(0, len(self.indices), chunksize):
+            counts += np.bincount(self.indices[i:i + chunksize], minlength=self.shape[1])
+        return counts
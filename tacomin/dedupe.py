@@ -0,0 +1,68 @@
+import hashlib
+from collections import defaultdict
+
+
+def member_hash(data):
+    """Hash of the raw bytes of a tar member."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def sheet_hash(df):
+    """Hash of the cropped 100x100 cell grid of a sheet, as the cells are seen by the vocab."""
+    values = df.values[:100, :100]
+    h = hashlib.blake2b(repr(values.shape).encode(), digest_size=16)
+    h.update('\x1f'.join(str(v)[:20] for v in values.flatten()).encode())
+    return h.digest()
+
+
+class Deduplicator:
+    """
+    Track exact duplicate members and sheets while streaming a tar.
+
+    Members are identified by their file name (the last part of the tar path), like in
+    the meta file. `duplicates` maps every skipped (member, sheet nr) to the row (fs) of
+    its canonical copy in the token matrix. With the hashes() of an earlier run, copies
+    of the members and sheets seen then are found too.
+    """
+
+    def __init__(self, hashes=None):
+        hashes = hashes or {}
+        self.member_hashes = dict(hashes.get('members', {}))
+        self.sheet_hashes = dict(hashes.get('sheets', {}))
+        self.member_sheets = defaultdict(list, {name: list(fs) for name, fs in hashes.get('member_sheets', {}).items()})
+        self.duplicates = {}
+
+    def hashes(self):
+        """The member and sheet hashes seen so far, to store in the meta file."""
+        return {'members': self.member_hashes, 'sheets': self.sheet_hashes, 'member_sheets': dict(self.member_sheets)}
+
+    def is_duplicate_member(self, name, data):
+        """Record the member and return True if its bytes were seen before, in which
+        case all its sheets are mapped to the sheets of the canonical member."""
+        name = name.split('/')[-1]
+        canonical = self.member_hashes.setdefault(member_hash(data), name)
+        if canonical == name:
+            return False
+        for snr, fs in enumerate(self.member_sheets[canonical]):
+            self.duplicates[name, snr] = fs
+        return True
+
+    def canonical_sheet(self, name, snr, df, fs):
+        """Return the fs of an identical sheet seen before, or None if the sheet is new and
+        will get row `fs`."""
+        name = name.split('/')[-1]
+        canonical = self.sheet_hashes.setdefault(sheet_hash(df), fs)
+        self.member_sheets[name].append(canonical)
+        if canonical == fs:
+            return None
+        self.duplicates[name, snr] = canonical
+        return canonical
+
+
+def copies(duplicates):
+    """Invert a duplicate map to fs -> [(member, sheet nr), ...], to expand results on the
+    unique sheets back to all copies."""
+    res = defaultdict(list)
+    for member, fs in duplicates.items():
+        res[fs].append(member)
+    return dict(res)
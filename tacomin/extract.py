@@ -0,0 +1,139 @@
+import io
+import os
+import tarfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .build_vocab import NROWS, pack, save
+from .dedupe import Deduplicator
+from .sample import estimate, in_sample
+from . import telemetry
+from .index import write_manifest
+
+# Suppress warning for xlrd
+import warnings
+# Filter all warning that start with "WARNING"
+warnings.filterwarnings('ignore')
+
+
+def encode_sheet(df, vocab):
+    """Map the cropped 100x100 cells of a sheet to vocab ids, adding unseen words to the vocab.
+
+    The cells are factorized first, so only the distinct values are converted to strings,
+    truncated and looked up in the vocab, and no long cell is copied into every other one.
+    Returns the (i, j, v) arrays of the non-empty cells, for the tall layout, and the sorted
+    unique ids in the sheet (including the empty cell), for the token matrix.
+    """
+    values = df.values[:100, :100]
+    codes, uniques = pd.factorize(values.ravel(), use_na_sentinel=False)
+    unique_ids = np.array([vocab.setdefault(str(w)[:20], len(vocab)) for w in uniques], dtype=np.int32)
+    ids = unique_ids[codes]
+    ii, jj = np.divmod(np.arange(len(ids)), max(values.shape[1], 1))
+    mask = ids != vocab.get('nan', -1)
+    return ii[mask].astype(np.int16), jj[mask].astype(np.uint8), ids[mask], np.unique(unique_ids)
+
+
+def write_tall(tall, output_dir, batch_nr):
+    dfc = pd.concat(tall, ignore_index=True)
+    dfc.to_parquet(os.path.join(output_dir, f'df_{batch_nr:04d}.parquet'), compression='zstd')
+    return dfc.shape
+
+
+def extract(tar, output_tall_dir, batch_size=1000, dedupe=True, sample_rate=None, dedup=None):
+    """Parse every sheet in the tar stream once, collecting the token sets for the
+    sparse matrix and writing the tall (fs, i, j, v) cells in batches of sheets.
+    Exact duplicate members and sheets are skipped and recorded in the duplicate map,
+    and with a sample_rate only the members in the sample are read."""
+    vocab = {}
+    words_member = []
+    words = []
+    dedup = Deduplicator() if dedup is None else dedup
+    tall = []
+    batch_nr = 0
+    t0 = time.time()
+    total_time_open = 0
+    num_files = 0
+    for member in tar:
+        t0_loop = time.time()
+        if not member.isfile() or not in_sample(member.name, sample_rate):
+            continue
+        try:
+            data = tar.extractfile(member).read()
+            if dedupe and dedup.is_duplicate_member(member.name, data):
+                continue
+            dfs = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None, index_col=None, nrows=NROWS)
+        except Exception:
+            continue
+        total_time_open += time.time() - t0_loop
+        num_files += 1
+        for dfi, df in enumerate(dfs.values()):
+            fs = len(words)
+            if dedupe and dedup.canonical_sheet(member.name, dfi, df, fs) is not None:
+                continue
+            i, j, v, ids = encode_sheet(df, vocab)
+            words.append(ids)
+            words_member.append((member, dfi))
+            tall.append(pd.DataFrame({'fs': np.full(len(v), fs, dtype=np.int32), 'i': i, 'j': j, 'v': v}))
+            if len(tall) >= batch_size:
+                shape = write_tall(tall, output_tall_dir, batch_nr)
+                tall = []
+                batch_nr += 1
+                t1 = time.time()
+                print(f'{len(words)}', f'{len(words) / (t1 - t0):.1f}', f'{total_time_open / (t1 - t0):.2%}',
+                      member.name, '  ', len(vocab), num_files, shape)
+    if tall:
+        write_tall(tall, output_tall_dir, batch_nr)
+    print('Final count:', len(words), len(vocab), num_files, len(dedup.duplicates))
+    telemetry.record(items=len(words), parse=total_time_open, files=num_files, vocab=len(vocab))
+    return vocab, words_member, words, dedup.duplicates
+
+
+def save_tall_meta(vocab, words_member, output_tall_dir):
+    # Same layout as the vocab and words_member files written by compress.to_parquet
+    vocab_df = pd.DataFrame(vocab.items(), columns=['word', 'id'])
+    vocab_df.to_parquet(os.path.join(output_tall_dir, 'vocab.parquet'), compression='zstd')
+    dfm = pd.DataFrame([(w.name.split('/')[-1], snr) for w, snr in words_member], columns=['word', 'member'])
+    dfm['index'] = dfm.index
+    dfm['filename'] = [w.name for w, _ in words_member]
+    dfm.to_parquet(os.path.join(output_tall_dir, 'words_member.parquet'))
+
+
+def main(
+        input_file='~/Downloads/fuse-binaries-dec2014.tar.gz',
+        output_data_file='experiments/results/data.npz',
+        output_meta_file='experiments/results/meta.pkl',
+        output_tall_dir='experiments/results/parquet_tall',
+        dedupe=True,
+        sample_rate=None,
+):
+    """Build the token matrix, the meta file and the tall parquet in one pass over the
+    input tar. Vocab ids are shared: the column of a word in the matrix is its `v` in the
+    tall parquet, and `fs` is the row of the sheet in the matrix."""
+    t0 = time.time()
+    os.makedirs(output_tall_dir, exist_ok=True)
+    tar_stream = tarfile.open(input_file, mode='r|*')
+    with telemetry.span('extract', 'load'):
+        dedup = Deduplicator()
+        vocab, words_member, words, duplicates = extract(tar_stream, output_tall_dir, dedupe=dedupe, sample_rate=sample_rate,
+                                                         dedup=dedup)
+        t1 = time.time()
+        estimate('extract', len(words), t1 - t0, sample_rate)
+    print('Time taken', t1 - t0)
+
+    print('Packing')
+    with telemetry.span('extract', 'save') as span:
+        x = pack(words_member, words)
+        print('x shape', x.shape)
+        save(x, vocab, words_member, output_data_file, output_meta_file, duplicates, dedup.hashes() if dedupe else None)
+        save_tall_meta(vocab, words_member, output_tall_dir)
+        write_manifest(output_tall_dir)
+        span.items = x.nnz
+    t2 = time.time()
+    print('Time taken', t2 - t1)
+    print('Total time taken', t2 - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb
+import tqdm
+
+# Cell offsets (di, dj) hashed together per kind of shingle, relative to its top-left cell
+SHINGLES = {
+    'block': [(0, 0), (0, 1), (1, 0), (1, 1)],
+    'row': [(0, 0), (0, 1), (0, 2)],
+}
+
+
+def fingerprint_file(parquet_file, output_file, kind='block', threads=1):
+    """
+    Write the (fs, i, j, h, h_rows, h_cols) fingerprints of the sheets in one tall parquet file:
+    one hash h per shingle of non-empty cells anchored at (i, j), with the shingle's size.
+    """
+    offsets = SHINGLES[kind]
+    joins = '\n'.join(
+        f'join c as c{n} on c{n}.fs = c0.fs and c{n}.i = c0.i + {di} and c{n}.j = c0.j + {dj}'
+        for n, (di, dj) in enumerate(offsets) if n > 0)
+    values = ', '.join(f'c{n}.v' for n in range(len(offsets)))
+    h_rows = max(di for di, _ in offsets) + 1
+    h_cols = max(dj for _, dj in offsets) + 1
+    con = duckdb.connect(config={'threads': threads})
+    con.sql(f"""
+    copy (
+    with c as (select fs, cast(i as int) as i, cast(j as int) as j, v from '{parquet_file}')
+    select c0.fs, cast(c0.i as smallint) as i, cast(c0.j as utinyint) as j, hash({values}) as h,
+        cast({h_rows} as utinyint) as h_rows, cast({h_cols} as utinyint) as h_cols
+    from c as c0
+    {joins}
+    order by c0.fs, c0.i, c0.j
+    ) to '{output_file}' (format parquet, compression zstd)
+    """)
+    con.close()
+
+
+def build(parquet_tall_dir, fingerprint_dir, kind='block', n_jobs=None):
+    """Fingerprint every tall parquet file in parallel, into fingerprint_dir/fp_*.parquet. The
+    files of an earlier build are removed first, as the tall files may have been reclustered."""
+    t0 = time.time()
+    os.makedirs(fingerprint_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(fingerprint_dir, 'fp_*.parquet')):
+        os.remove(old)
+    files = sorted(glob.glob(os.path.join(parquet_tall_dir, 'df_*.parquet')))
+
+    def run(file):
+        fingerprint_file(file, os.path.join(fingerprint_dir, 'fp_' + os.path.basename(file)[3:]), kind=kind)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        list(tqdm.tqdm(pool.map(run, files), total=len(files)))
+    print('Time taken', time.time() - t0)
+
+
+def moves_batch(pairs, fingerprint_dir, output_file, n_move_size=5, threads=1, max_fingerprint_cells=None):
+    """
+    Find the moves within one batch of (afs, bfs) pairs from shared fingerprints, with the
+    same columns as refine.moves_batch. move_size and move_weight count the shared shingles,
+    and the bounds cover the cells of those shingles.
+    max_fingerprint_cells drops fingerprints that occur more often than that in a sheet,
+    such as blocks of one repeated value.
+    """
+    con = duckdb.connect(config={'threads': threads})
+    con.register('pairs', pairs)
+    fingerprints = f"""
+        select * from '{fingerprint_dir}/fp_*.parquet'
+        where fs in (select afs from pairs union select bfs from pairs)"""
+    if max_fingerprint_cells is not None:
+        fingerprints = f"""
+        select * from ({fingerprints})
+        qualify count(*) over (partition by fs, h) <= {max_fingerprint_cells}"""
+    con.sql(f"""
+    copy (
+    with F as ({fingerprints}
+    ),
+    diff as (
+        select a.fs as afs, b.fs as bfs, cast(a.i as int) - b.i as di, cast(a.j as int) - b.j as dj,
+            a.i as i1, a.j as j1, b.i as i2, b.j as j2, a.h_rows - 1 as ei, a.h_cols - 1 as ej
+        from pairs as p
+        join F as a on a.fs = p.afs
+        join F as b on b.fs = p.bfs and a.h = b.h
+    )
+    select afs, bfs, di, dj, count(*) as move_size, cast(count(*) as double) as move_weight,
+        min(i1) as mini1, min(j1) as minj1, max(i1 + ei) as maxi1, max(j1 + ej) as maxj1,
+        min(i2) as mini2, min(j2) as minj2, max(i2 + ei) as maxi2, max(j2 + ej) as max2j
+    from diff
+    group by afs, bfs, di, dj
+    having move_size > {n_move_size}
+    ) to '{output_file}' (format parquet)
+    """)
+    con.close()
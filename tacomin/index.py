@@ -0,0 +1,102 @@
+import glob
+import os
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+def row_groups(files):
+    """The (file, row_group, fs_min, fs_max, num_rows) of every row group of the tall parquet
+    files, from the statistics in their footers."""
+    rows = []
+    for file in files:
+        meta = pq.ParquetFile(file).metadata
+        fs_col = meta.schema.names.index('fs')
+        for r in range(meta.num_row_groups):
+            stats = meta.row_group(r).column(fs_col).statistics
+            rows.append((os.path.basename(file), r, stats.min, stats.max, meta.row_group(r).num_rows))
+    return pd.DataFrame(rows, columns=['file', 'row_group', 'fs_min', 'fs_max', 'num_rows'])
+
+
+def write_manifest(parquet_tall_dir):
+    """Write manifest.parquet, the row_groups of the tall files in the directory."""
+    files = sorted(glob.glob(os.path.join(parquet_tall_dir, 'df_*.parquet')))
+    row_groups(files).to_parquet(os.path.join(parquet_tall_dir, 'manifest.parquet'))
+
+
+def tall_source(parquet_tall_dir, fs=None):
+    """
+    The DuckDB source of the tall cells. With the sheets fs and a manifest, only the files
+    with a row group whose fs range holds one of those sheets are read.
+    """
+    manifest_file = os.path.join(parquet_tall_dir, 'manifest.parquet')
+    if fs is None or len(fs) == 0 or not os.path.exists(manifest_file):
+        return f"'{parquet_tall_dir}/df_*.parquet'"
+    manifest = pd.read_parquet(manifest_file)
+    fs = np.unique(fs)
+    first = np.searchsorted(fs, manifest.fs_min.to_numpy())
+    hit = (first < len(fs)) & (fs[np.minimum(first, len(fs) - 1)] <= manifest.fs_max.to_numpy())
+    files = [os.path.join(parquet_tall_dir, f) for f in sorted(manifest.file[hit].unique())]
+    if not files:
+        return f"'{parquet_tall_dir}/df_*.parquet'"
+    return f'read_parquet({files!r})'
+
+
+def build(parquet_tall_dir, index_file):
+    """
+    Build a DuckDB database from the tall parquet with
+    - cells (fs, i, j, v), sorted by fs, for lookups by sheet
+    - postings (v, fs, i, j), sorted by value, for lookups by value
+    - value_df (v, df, cf), the number of sheets and cells per value
+    - sheet_location (file, row_group, fs_min, fs_max, num_rows), where the sheets are in
+      the parquet files.
+    The sort orders let DuckDB skip all but the row groups of the value or sheet asked for.
+    """
+    t0 = time.time()
+    files = sorted(glob.glob(os.path.join(parquet_tall_dir, 'df_*.parquet')))
+    con = duckdb.connect(index_file)
+    con.sql(f"""
+    create or replace table cells as
+    select fs, i, j, v from '{parquet_tall_dir}/df_*.parquet' order by fs, i, j
+    """)
+    con.sql("create or replace table postings as select v, fs, i, j from cells order by v, fs, i, j")
+    con.sql("""
+    create or replace table value_df as
+    select v, count(distinct fs) as df, count(*) as cf from cells group by v order by v
+    """)
+    locations = row_groups(files)
+    con.sql("create or replace table sheet_location as select * from locations")
+    print('Index', con.sql('select count(*) from cells').fetchone()[0], 'cells',
+          con.sql('select count(*) from value_df').fetchone()[0], 'values', len(files), 'files')
+    con.close()
+    print('Time taken', time.time() - t0)
+
+
+def connect(index_file):
+    return duckdb.connect(index_file, read_only=True)
+
+
+def sheets_with_value(con, v):
+    """The (fs, i, j) positions of a value, and its document frequency."""
+    positions = con.execute('select fs, i, j from postings where v = ? order by fs, i, j', [v]).df()
+    df = con.execute('select df from value_df where v = ?', [v]).fetchone()
+    return positions, df[0] if df else 0
+
+
+def sheet(con, fs):
+    """The (i, j, v) cells of a sheet."""
+    return con.execute('select i, j, v from cells where fs = ? order by i, j', [fs]).df()
+
+
+def offset_histogram(con, afs, bfs):
+    """Number of equal values per offset (di, dj) of sheet bfs relative to sheet afs."""
+    return con.execute("""
+    with a as (select * from cells where fs = ?), b as (select * from cells where fs = ?)
+    select cast(a.i as int) - b.i as di, cast(a.j as int) - b.j as dj, count(*) as n
+    from a join b on a.v = b.v
+    group by di, dj
+    order by n desc, di, dj
+    """, [afs, bfs]).df()
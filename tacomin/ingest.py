@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+import tarfile
+import time
+
+import numpy as np
+import pyarrow.parquet as pq
+from scipy.sparse import csr_matrix, save_npz
+
+from .build_vocab import load_from_tar, load_meta, save_meta
+from .collect import TopCollector
+from .compare import blocks_dir, tfidf, topk_segments
+from .corpus import corpus_dir, open_corpus
+from .dedupe import Deduplicator
+from .search import score_block
+from . import telemetry
+
+
+def extend_matrix(corpus, words, n_cols):
+    """The rows of the corpus followed by the new rows of sorted ids, as a CSR matrix with n_cols columns."""
+    lengths = np.array([len(w) for w in words], dtype=np.int64)
+    indptr = np.concatenate([corpus.indptr.astype(np.int64), corpus.indptr[-1] + np.cumsum(lengths)])
+    indices = np.concatenate([corpus.indices] + list(words)).astype(np.int32, copy=False)
+    if indptr[-1] < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    y = csr_matrix((np.ones(len(indices), dtype=np.uint8), indices, indptr), shape=(len(indptr) - 1, n_cols), copy=False)
+    y.has_sorted_indices = True
+    return y
+
+
+def save_matrix(x, data_file):
+    """Write data_file and its corpus directory next to the ones in use. The files are
+    swapped in with os.replace, so corpora that are still mapped keep their old pages."""
+    directory = corpus_dir(data_file)
+    tmp_file = data_file + '.tmp.npz'
+    save_npz(tmp_file, x)
+    os.replace(tmp_file, data_file)
+    for name, arr in [('indptr', x.indptr), ('indices', x.indices)]:
+        tmp_file = os.path.join(directory, name + '.tmp.npy')
+        np.save(tmp_file, arr)
+        os.replace(tmp_file, os.path.join(directory, name + '.npy'))
+    with open(os.path.join(directory, 'shape.json'), 'w') as f:
+        json.dump(list(x.shape), f)
+
+
+def update_topk(xd, top, top_scores, new_rows, k):
+    """
+    Neighbours for the new rows, and the existing rows whose top k list a new row enters.
+
+    The dot products of the new rows with all rows give both: the new rows' own top k,
+    and per existing row the new rows that score above the last entry of its list. Only
+    those lists are merged again. Returns the extended top and scores and the rows whose
+    list changed, new rows included.
+    """
+    n_old = top.shape[0]
+    xdt = xd.T.tocsr()
+    dots = (xd[new_rows] @ xdt).tocoo()
+    row, col, score = new_rows[dots.row], dots.col, dots.data
+    keep = row != col
+    row, col, score = row[keep], col[keep], score[keep]
+    new_top, new_scores = topk_segments(row - n_old, col, score, len(new_rows), k)
+
+    # A new row j enters the list of an existing row i with the same score as i in j's
+    old = col < n_old
+    i, j, s = col[old], row[old], score[old]
+    threshold = np.where(top[:, -1] >= 0, top_scores[:, -1], -np.inf)
+    enters = s > threshold[i]
+    i, j, s = i[enters], j[enters], s[enters]
+    changed = np.unique(i)
+    top = np.concatenate([top, new_top])
+    top_scores = np.concatenate([top_scores, new_scores])
+    if len(changed):
+        local = np.searchsorted(changed, i)
+        current = top[changed].ravel()
+        valid = current >= 0
+        rows = np.concatenate([np.repeat(np.arange(len(changed)), k)[valid], local])
+        cols = np.concatenate([current[valid], j])
+        scores = np.concatenate([top_scores[changed].ravel()[valid], s])
+        top[changed], top_scores[changed] = topk_segments(rows, cols, scores, len(changed), k)
+    return top, top_scores, np.concatenate([changed, new_rows]).astype(np.int64)
+
+
+def rescore_anchors(x, top, anchors, tripples, top_n=None, metrics=('geo_area',), score=None, chunksize=1000,
+                    lengths=None):
+    """Replace the triples of anchors in the triples file by ones scored on the current top lists,
+    keeping the best top_n triples overall (all by default)."""
+    tmp_file = tripples + '.tmp'
+    collector = TopCollector(tmp_file, n=top_n)
+    anchors = np.sort(anchors)
+    if os.path.exists(tripples):
+        for batch in pq.ParquetFile(tripples).iter_batches(batch_size=1_000_000):
+            df = batch.to_pandas()
+            collector.add(df[~np.isin(df.i.to_numpy(), anchors)])
+    for start in range(0, len(anchors), chunksize):
+        collector.add(score_block(x, top, anchors[start:start + chunksize], metrics, score, lengths))
+    df = collector.close()
+    os.replace(tmp_file, tripples)
+    return df
+
+
+def main(input_file, data_file='experiments/results/data.npz', meta_file='experiments/results/meta.pkl',
+         top_file='experiments/results/top20.npz', tripples='experiments/results/ftripples.parquet',
+         top_k=20, dedupe=True, top_n=None, metrics=('geo_area',), score=None, sample_rate=None):
+    """
+    Append the sheets of another tar to the corpus: the vocab and meta file, the token
+    matrix, the top k neighbours and the triples are extended in place.
+
+    Members already in the corpus, kept or deduplicated, are skipped. New members and
+    sheets that copy ones in the corpus, by the hashes in the meta file, or each other
+    are deduplicated. Neighbour scores use the tf-idf weights of the extended corpus; the
+    scores kept for existing lists are not recomputed, so a full compare now and then
+    resets the drift.
+    The members themselves stay in input_file, so compress has to read it next to the
+    original tar.
+    """
+    t0 = time.time()
+    vocab, words_member, duplicates, hashes = load_meta(meta_file, with_hashes=True)
+    corpus = open_corpus(data_file)
+    n_old = len(corpus)
+    topo = np.load(top_file.format(k=top_k))
+    if 'scores' not in topo:
+        raise ValueError(f'{top_file} has no scores, run compare again before appending')
+    top, top_scores = topo['top'], topo['scores']
+
+    with telemetry.span('ingest', 'load'):
+        dedup = Deduplicator(hashes)
+        skip = {name for name, _ in words_member} | {name for name, _ in duplicates}
+        with tarfile.open(input_file, mode='r|*') as tar_stream:
+            _, new_members, words, new_duplicates = load_from_tar(
+                tar_stream, dedupe=dedupe, vocab=vocab, skip=skip, sample_rate=sample_rate, dedup=dedup, first_fs=n_old)
+        telemetry.record(items=len(words))
+    print('New sheets', len(words), 'vocab size', len(vocab))
+    words_member = words_member + [(w.name.split('/')[-1], snr) for w, snr in new_members]
+    duplicates = {**duplicates, **new_duplicates}
+    hashes = dedup.hashes() if dedupe else hashes
+    if not words:
+        # Only copies of sheets in the corpus, which are recorded as duplicates
+        save_meta(vocab, words_member, meta_file, duplicates, hashes)
+        return
+
+    with telemetry.span('ingest', 'neighbours') as span:
+        x = extend_matrix(corpus, words, len(vocab))
+        del corpus
+        new_rows = np.arange(n_old, x.shape[0])
+        top, top_scores, anchors = update_topk(tfidf(x), top, top_scores, new_rows, top.shape[1])
+        span.items = len(new_rows)
+    print('Lists changed', len(anchors) - len(new_rows))
+
+    with telemetry.span('ingest', 'save'):
+        save_matrix(x, data_file)
+        save_meta(vocab, words_member, meta_file, duplicates, hashes)
+        corpus = open_corpus(data_file)
+        df = corpus.document_frequencies()
+        np.savez_compressed(top_file.format(k=top_k), top=top, scores=top_scores, df=df)
+        # Blocks of an interrupted out-of-core compare are of the old corpus
+        shutil.rmtree(blocks_dir(top_file.format(k=top_k)), ignore_errors=True)
+
+    with telemetry.span('ingest', 'triples') as span:
+        rescore_anchors(x, top, anchors, tripples, top_n=top_n, metrics=metrics, score=score,
+                        lengths=corpus.lengths())
+        span.items = len(anchors)
+    print('Anchors rescored', len(anchors))
+    print('Time taken', time.time() - t0)
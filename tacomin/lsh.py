@@ -0,0 +1,67 @@
+import numpy as np
+
+# Mersenne prime for the universal hash functions h(x) = (a * x + b) mod P
+PRIME = (1 << 31) - 1
+
+
+def minhash_signatures(x, num_perm=64, seed=0):
+    """
+    MinHash signatures of the token set of every row of a CSR matrix.
+
+    Returns a (rows, num_perm) uint32 array. Empty rows get PRIME in every position, so
+    they never share a band with a non-empty row.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, num_perm, dtype=np.int64)
+    b = rng.integers(0, PRIME, num_perm, dtype=np.int64)
+    sig = np.full((x.shape[0], num_perm), PRIME, dtype=np.uint32)
+    nonempty = np.diff(x.indptr) > 0
+    starts = x.indptr[:-1][nonempty]
+    tokens = x.indices.astype(np.int64)
+    for p in range(num_perm):
+        h = (a[p] * tokens + b[p]) % PRIME
+        # Without the empty rows each segment runs up to the start of the next one
+        sig[nonempty, p] = np.minimum.reduceat(h, starts)
+    return sig
+
+
+def band_keys(sig, bands):
+    """Hash each band of rows // bands signature values to one uint64 bucket key per row."""
+    rows = sig.shape[1] // bands
+    mult = np.uint64(0x9E3779B97F4A7C15)
+    keys = np.zeros((sig.shape[0], bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for band in range(bands):
+            for r in range(rows):
+                keys[:, band] = keys[:, band] * mult + sig[:, band * rows + r]
+    return keys
+
+
+def candidate_pairs(sig, bands=16, max_bucket=50):
+    """
+    Pairs of rows that share at least one band bucket.
+
+    Rows are sorted by bucket key per band and each row is paired with the next
+    max_bucket - 1 rows in its bucket, which caps the fan-out of very large buckets
+    (mostly near-empty sheets). Returns unique (row, col) arrays with both directions.
+    """
+    keys = band_keys(sig, bands)
+    empty = (sig == PRIME).all(axis=1)
+    rows, cols = [], []
+    for band in range(bands):
+        order = np.argsort(keys[:, band], kind='stable')
+        order = order[~empty[order]]
+        sorted_keys = keys[order, band]
+        for d in range(1, max_bucket):
+            if d >= len(order):
+                break
+            same = sorted_keys[:-d] == sorted_keys[d:]
+            if not same.any():
+                break
+            rows.append(order[:-d][same])
+            cols.append(order[d:][same])
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    pairs = np.unique(np.concatenate([rows * sig.shape[0] + cols, cols * sig.shape[0] + rows]))
+    return np.divmod(pairs, sig.shape[0])
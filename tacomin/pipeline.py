@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import telemetry
+
+
+class Stage:
+    """
+    A step of the pipeline: run() reads the inputs and writes the outputs, both file or
+    directory paths, and params are the settings that change what it writes.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.run = run
+        self.inputs = [os.path.expanduser(p) for p in inputs]
+        self.outputs = [os.path.expanduser(p) for p in outputs]
+        self.params = params or {}
+
+
+def file_key(path):
+    """Identify an input that no stage writes by its path, size and modification time."""
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class Pipeline:
+    """
+    Run stages in dependency order, skipping the ones that are up to date.
+
+    A stage depends on the stages that write its inputs. Its key is a hash of its name,
+    params and the keys of its inputs: the key of the producing stage for an artifact, or
+    file_key for an external input. Keys therefore change whenever anything upstream does,
+    without hashing the artifacts themselves. After a stage has run its key is stamped in
+    stamp_dir, and it is up to date while the stamp matches and its outputs exist.
+    Stages whose dependencies are done run concurrently.
+    """
+
+    def __init__(self, stages, stamp_dir='.tac'):
+        self.stages = {stage.name: stage for stage in stages}
+        self.stamp_dir = stamp_dir
+        self.producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f'{output} is written by both {self.producers[output]} and {stage.name}')
+                self.producers[output] = stage.name
+
+    def dependencies(self, name):
+        return sorted({self.producers[p] for p in self.stages[name].inputs if p in self.producers})
+
+    def downstream(self, name):
+        """The stages that depend on stage name, directly or through other stages."""
+        found = set()
+        for other in self.stages:
+            if name in self.dependencies(other):
+                found |= {other} | self.downstream(other)
+        return found
+
+    def invalidate(self, names):
+        """Remove the stamps of stages, so the next run reruns them."""
+        for name in names:
+            if os.path.exists(self.stamp_file(name)):
+                os.remove(self.stamp_file(name))
+
+    def order(self, targets):
+        """The targets and every stage they depend on, dependencies first."""
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f'Cycle through stage {name}')
+            visiting.add(name)
+            for dependency in self.dependencies(name):
+                visit(dependency)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    def keys(self, order):
+        keys = {}
+        for name in order:
+            stage = self.stages[name]
+            inputs = [keys[self.producers[p]] if p in self.producers else file_key(p) for p in stage.inputs]
+            spec = json.dumps({'stage': name, 'params': stage.params, 'inputs': inputs}, sort_keys=True, default=str)
+            keys[name] = hashlib.sha256(spec.encode()).hexdigest()
+        return keys
+
+    def stamp_file(self, name):
+        return os.path.join(self.stamp_dir, name + '.json')
+
+    def up_to_date(self, name, key):
+        stamp_file = self.stamp_file(name)
+        if not os.path.exists(stamp_file):
+            return False
+        with open(stamp_file) as f:
+            stamp = json.load(f)
+        return stamp['key'] == key and all(os.path.exists(p) for p in self.stages[name].outputs)
+
+    def stamp(self, name, key, seconds):
+        with open(self.stamp_file(name), 'w') as f:
+            json.dump({'key': key, 'outputs': self.stages[name].outputs, 'params': self.stages[name].params,
+                       'seconds': seconds, 'time': time.time()}, f, indent=1, default=str)
+
+    def plan(self, targets, force=()):
+        """The stages needed for targets and, per stage, its key and whether it has to run."""
+        order = self.order(targets)
+        keys = self.keys(order)
+        return [(name, keys[name], name in force or not self.up_to_date(name, keys[name])) for name in order]
+
+    def run(self, targets, force=(), n_jobs=None):
+        """Bring targets up to date and return the names of the stages that ran."""
+        os.makedirs(self.stamp_dir, exist_ok=True)
+        plan = self.plan(targets, force)
+        for name, key, stale in plan:
+            print(f"{name:12} {key[:12]} {'run' if stale else 'up to date'}")
+        pending = {name: key for name, key, stale in plan if stale}
+        done = {name for name, _, stale in plan if not stale}
+        ran = []
+        running = {}
+
+        def run_stage(name):
+            t0 = time.time()
+            with telemetry.span(name):
+                self.stages[name].run()
+            return time.time() - t0
+
+        with ThreadPoolExecutor(max_workers=n_jobs or len(plan) or 1) as pool:
+            while pending or running:
+                for name in [n for n in pending if all(d in done for d in self.dependencies(n))]:
+                    key = pending.pop(name)
+                    if os.path.exists(self.stamp_file(name)):
+                        os.remove(self.stamp_file(name))
+                    running[pool.submit(run_stage, name)] = (name, key)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, key = running.pop(future)
+                    seconds = future.result()
+                    missing = [p for p in self.stages[name].outputs if not os.path.exists(p)]
+                    if missing:
+                        raise RuntimeError(f'Stage {name} did not write {", ".join(missing)}')
+                    self.stamp(name, key, seconds)
+                    print(f'Stage {name} done in {seconds:.1f}s')
+                    done.add(name)
+                    ran.append(name)
+        return ran
@@ -1,63 +1,124 @@
+import glob
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from scipy.sparse import load_npz
 import tqdm
-import matplotlib.pyplot as plt
 import pandas as pd
 import duckdb
 
+from . import fingerprint
+from .collect import TopCollector
+from .corpus import open_corpus
+from .index import tall_source
+from .sample import estimate
+from . import telemetry
+
 
 def load_data(x_file, top_file, k):
     # Load from disk
     print('Loading')
-    x = load_npz(x_file)
+    corpus = open_corpus(x_file)
+    x = corpus.matrix()
     topo = np.load(top_file.format(k=k))
     if 'arr_0' in topo:
         top = topo['arr_0']
     else:
         top = topo['top']
+    if 'df' in topo:
+        value_df = topo['df']
+    else:
+        value_df = corpus.document_frequencies()
     print('Loaded', x.shape, top.shape)
+    return top, x, value_df
 
-    x_lil = x.tolil()
-    x_set = [
-        set(row)
-        for row in x_lil.rows
-    ]
-    return top, x_set
 
+def value_weights(value_df, n_sheets, max_df=None):
+    """
+    The values that take part in the move join, with their idf as weight.
 
-def subset(top, x_set, k=20):
-    topa = top
-    scores = []
+    max_df drops values in more than max_df sheets, or in more than that fraction of the
+    sheets if it is a float below 1.
+    """
+    if max_df is not None and max_df < 1:
+        max_df = max_df * n_sheets
+    v = np.nonzero(value_df > 0)[0]
+    df = value_df[v]
+    if max_df is not None:
+        v, df = v[df <= max_df], df[df <= max_df]
+    return pd.DataFrame({'v': v.astype(np.int32), 'w': np.log(n_sheets / df).astype(np.float32)})
 
-    for i, xs in enumerate(tqdm.tqdm(x_set)):
-        for j in range(k):
-            j_ind = topa[i, j]
-            sa = x_set[i] & x_set[j_ind]
-            scores.append((i, j_ind, len(sa)))
 
-    # Sorting
-    scores = [(i, j, sa) for i ,j, sa in scores]
+def subset(top, x, k=20, n_contains=0, top_n=None, chunksize=10_000):
+    """Number of shared tokens (sa) between each sheet i and its top k neighbours j, as a
+    DataFrame of the pairs with sa >= n_contains, in order of i. With top_n only the best
+    top_n pairs are kept, sorted by sa."""
+    k = min(k, top.shape[1])
+    collector = TopCollector(n=top_n, min_score=n_contains - 1, score='sa') if top_n is not None else None
+    frames = []
+    for start in tqdm.tqdm(range(0, top.shape[0], chunksize)):
+        i = np.repeat(np.arange(start, min(start + chunksize, top.shape[0])), k)
+        j = top[start:start + chunksize, :k].ravel()
+        i, j = i[j >= 0], j[j >= 0]
+        sa = np.diff(x[i].multiply(x[j]).tocsr().indptr)
+        df = pd.DataFrame({'i': i, 'j': j, 'sa': sa})
+        if collector is not None:
+            collector.add(df)
+        else:
+            frames.append(df[df.sa >= n_contains])
+    scores = collector.close() if collector is not None else (pd.concat(frames, ignore_index=True) if frames else None)
+    return scores if scores is not None else pd.DataFrame({'i': [], 'j': [], 'sa': []}, dtype=int)
 
-    scores = sorted(scores, key=lambda x: x[2], reverse=True)
-    return scores
 
-def moves(scores, parquet_tall_dir, n_contains=5, n_move_size=5):
-    # Now find the moves by joining on value
-    res = duckdb.sql(f"""
-    with A as (
-        select * from '{parquet_tall_dir}/df_*.parquet'
-        where fs in ({','.join([str(s[0]) for s in scores if s[2] >= n_contains])})
+def candidate_pairs(scores, n_contains=5):
+    """The distinct (afs, bfs) sheet pairs, afs < bfs, that share at least n_contains tokens."""
+    pairs = scores[scores.sa >= n_contains]
+    return pd.DataFrame({
+        'afs': np.minimum(pairs.i, pairs.j).astype(np.int32),
+        'bfs': np.maximum(pairs.i, pairs.j).astype(np.int32),
+    }).drop_duplicates(ignore_index=True)
+
+
+def moves_batch(pairs, parquet_tall_dir, output_file, n_move_size=5, threads=1, values=None, max_value_cells=None,
+                index_file=None):
+    """
+    Find the moves within one batch of candidate pairs and write them to output_file.
+
+    With values, a frame of (v, w), only those values are joined and each matching cell
+    votes w for its offset, summed as move_weight (otherwise move_weight = move_size).
+    max_value_cells drops values that fill more than that many cells of a sheet.
+    With index_file, the cells are read from the index database instead of the parquet files.
+    """
+    con = duckdb.connect(config={'threads': threads})
+    con.register('pairs', pairs)
+    tall = tall_source(parquet_tall_dir, np.concatenate([pairs.afs, pairs.bfs]))
+    if index_file is not None:
+        con.sql(f"attach '{index_file}' as idx (read_only)")
+        tall = 'idx.cells'
+    if values is not None:
+        con.register('vals', values)
+    cells = f"""
+        select c.*, {'vals.w' if values is not None else '1.0'} as w
+        from {tall} as c {'join vals using (v)' if values is not None else ''}
+        where fs in (select afs from pairs union select bfs from pairs)"""
+    if max_value_cells is not None:
+        cells = f"""
+        select * from ({cells})
+        qualify count(*) over (partition by fs, v) <= {max_value_cells}"""
+    con.sql(f"""
+    copy (
+    with A as ({cells}
     ),
     diff as (
         select a.fs as afs, b.fs as bfs, a.v as v, cast(a.i as int) - b.i as di, cast(a.j as int) - b.j as dj,
-            a.i as i1, a.j as j1, b.i as i2, b.j as j2
-        from A as a join A as b
-        on a.v = b.v and a.fs < b.fs
+            a.i as i1, a.j as j1, b.i as i2, b.j as j2, a.w as w
+        from pairs as p
+        join A as a on a.fs = p.afs
+        join A as b on b.fs = p.bfs and a.v = b.v
     ),
     moves as (
-        select afs, bfs, di, dj, count(*) as move_size,
+        select afs, bfs, di, dj, count(*) as move_size, sum(w) as move_weight,
             min(i1) as mini1, min(j1) as minj1, max(i1) as maxi1, max(j1) as maxj1,
             min(i2) as mini2, min(j2) as minj2, max(i2) as maxi2, max(j2) as max2j
         from diff
@@ -65,79 +126,106 @@ def moves(scores, parquet_tall_dir, n_contains=5, n_move_size=5):
         having move_size > {n_move_size}
     )
     select * from moves
+    ) to '{output_file}' (format parquet)
     """)
-    df_moves = res.to_df()
-    return df_moves
+    con.close()
+
+
+def moves(scores, parquet_tall_dir, output_dir, n_contains=5, n_move_size=5, batch_size=1000, n_jobs=None,
+          values=None, max_value_cells=None, index_file=None, fingerprint_dir=None):
+    """
+    Find the moves between candidate sheet pairs by joining their cells on value.
+
+    Only the cells of the (i, j) pairs in scores with at least n_contains shared tokens are
+    joined. The pairs are split in batches that run in parallel, each on its own DuckDB
+    connection, and each batch writes its moves to output_dir/moves_*.parquet.
+    values and max_value_cells prune and weight the joined values, and index_file reads the
+    cells from the index (see moves_batch). With fingerprint_dir the pairs are joined on their
+    shared fingerprints instead of cell values (see fingerprint.moves_batch), and
+    max_value_cells caps the fingerprints per sheet.
+    Returns the glob of the written files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(output_dir, 'moves_*.parquet')):
+        os.remove(old)
+    pairs = candidate_pairs(scores, n_contains)
+    print('Candidate pairs', len(pairs))
+    batches = [pairs[b:b + batch_size] for b in range(0, len(pairs), batch_size)] or [pairs]
+    n_jobs = n_jobs or os.cpu_count()
+    threads = max(1, os.cpu_count() // n_jobs)
+
+    def run(b):
+        output_file = os.path.join(output_dir, f'moves_{b:05d}.parquet')
+        if fingerprint_dir is not None:
+            fingerprint.moves_batch(batches[b], fingerprint_dir, output_file, n_move_size=n_move_size, threads=threads,
+                                    max_fingerprint_cells=max_value_cells)
+            return
+        moves_batch(batches[b], parquet_tall_dir, output_file,
+                    n_move_size=n_move_size, threads=threads, values=values, max_value_cells=max_value_cells,
+                    index_file=index_file)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        list(tqdm.tqdm(pool.map(run, range(len(batches))), total=len(batches)))
+    return os.path.join(output_dir, 'moves_*.parquet')
+
 
 def concat(df_moves):
-    # Now find triples where the same sheet is involved with two moves
+    """
+    Find concat triples: a target sheet with two moves from different sources whose blocks
+    are adjacent, either vertically (the last row of source1's block is just above the first
+    row of source2's block, and their columns overlap) or horizontally (the same for columns).
+
+    df_moves is a frame of moves or the glob of the parquet files moves() wrote. Both
+    orientations of every move are used, so a sheet can be the target as afs or as bfs.
+    """
+    source = f"'{df_moves}'" if isinstance(df_moves, str) else 'df_moves'
     res = duckdb.sql(f"""
-    with move_rels as (
-        select distinct afs, bfs from df_moves
-    ),
-    move_counts as (
-        select afs as fs, count(*) as cnt from move_rels group by afs
+    with targets as (
+        select afs as fs, bfs as source, mini1 as mini, minj1 as minj, maxi1 as maxi, maxj1 as maxj
+        from {source}
         union all
-        select bfs as fs, count(*) as cnt from move_rels group by bfs
+        select bfs as fs, afs as source, mini2 as mini, minj2 as minj, maxi2 as maxi, max2j as maxj
+        from {source}
     )
-    select fs, sum(cnt) as cnt
-    from move_counts
-    group by fs
-    having cnt >= 3
-    order by cnt desc
+    select distinct m1.fs, m1.source as source1, m2.source as source2,
+        case when m1.maxi + 1 = m2.mini then 'v' else 'h' end as axis,
+        m1.maxi, m2.mini, m1.maxj, m2.minj
+    from targets as m1 join targets as m2
+    on m1.fs = m2.fs and m1.source <> m2.source
+    where (m1.maxi + 1 = m2.mini and m1.minj <= m2.maxj and m2.minj <= m1.maxj)
+        or (m1.maxj + 1 = m2.minj and m1.mini <= m2.maxi and m2.mini <= m1.maxi)
+    order by m1.fs, source1, source2
     """)
-    df_triple_candidates = res.to_df()
-    #print(df_triple_candidates.shape)
-
-    # Now find the moves where the max of one is the min of the other
-    moves = []
-    for fs in tqdm.tqdm(df_triple_candidates.fs):
-        fso = df_moves.query('afs == @fs')
-        #print(fs, fso.shape)
-        if len(fso) < 2:
-            #print(f"Skipping {fs} as it has only {len(fso)} move")
-            continue
-        target_mini = []
-        target_minj = []
-        target_maxi = []
-        target_maxj = []
-        source_fs = []
-        for i, row in fso.iterrows():
-            if row['afs'] == fs:  # target <- source
-                source_fs.append(row['bfs'])
-                target_mini.append(row['mini1'])
-                target_minj.append(row['minj1'])
-                target_maxi.append(row['maxi1'])
-                target_maxj.append(row['maxj1'])
-            else:  # target <- source
-                source_fs.append(row['afs'])
-                target_mini.append(row['mini2'])
-                target_minj.append(row['minj2'])
-                target_maxi.append(row['maxi2'])
-                target_maxj.append(row['maxj2'])
-        # Now find the moves where the max of one is the min of the other
-        for s1, mini in enumerate(target_mini):
-            for s2, maxi in enumerate(target_maxi):
-                if maxi + 1 == mini:
-                    #print(f"Found concat: {source_fs[s1]} -> {fs} <- {source_fs[s2]}  {maxi}:{mini}")
-                    moves.append((fs, source_fs[s1], source_fs[s2], maxi, mini))
-    df_concat = pd.DataFrame(moves, columns=['fs', 'source1', 'source2', 'maxi', 'mini'])
-    return df_concat
-
-
-def main(x_file, top_file, parquet_tall_dir, top_k=20, n_contains=5, n_move_size=5):
-    top, x_set = load_data(x_file, top_file, top_k)
+    return res.to_df()
+
+
+def main(x_file, top_file, parquet_tall_dir, top_k=20, n_contains=5, n_move_size=5,
+         moves_dir='experiments/results/moves', n_jobs=None, max_df=None, max_value_cells=None, weight_moves=False,
+         index_file=None, fingerprint_dir=None, sample_rate=None):
+    with telemetry.span('refine', 'load') as span:
+        top, x, value_df = load_data(x_file, top_file, top_k)
+        values = value_weights(value_df, x.shape[0], max_df) if max_df is not None or weight_moves else None
+        span.items = x.shape[0]
     t0 = time.time()
-    scores = subset(top, x_set, k=top_k)
-    filtered_scores = [(i, j, sa) for i ,j, sa in scores if sa >= n_contains]
+    with telemetry.span('refine', 'subset') as span:
+        scores = subset(top, x, k=top_k, n_contains=n_contains)
+        filtered_scores = scores[scores.sa >= n_contains]
+        span.items = len(scores)
     t1 = time.time()
     print('Scores: ', len(filtered_scores))
     print('Score time: ', t1 - t0)
-    df_moves = moves(scores, parquet_tall_dir, n_contains=n_contains, n_move_size=n_move_size)
+    with telemetry.span('refine', 'moves') as span:
+        moves_files = moves(scores, parquet_tall_dir, moves_dir, n_contains=n_contains, n_move_size=n_move_size, n_jobs=n_jobs,
+                            values=values, max_value_cells=max_value_cells, index_file=index_file,
+                            fingerprint_dir=fingerprint_dir)
+        span.items = len(filtered_scores)
     t2 = time.time()
-    print('Moves: ', df_moves.shape)
+    print('Moves: ', duckdb.sql(f"select count(*) from '{moves_files}'").fetchone()[0])
     print('Move time', t2 - t1)
-    df_concat = concat(df_moves)
+    with telemetry.span('refine', 'concat') as span:
+        df_concat = concat(moves_files)
+        span.items = len(df_concat)
     t3 = time.time()
     print('Concat: ', df_concat.shape)
     print('Concat time', t3 - t2)
+    estimate('refine', len(filtered_scores), t3 - t0, sample_rate)
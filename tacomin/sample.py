@@ -0,0 +1,30 @@
+import hashlib
+
+from . import telemetry
+
+
+def in_sample(name, rate=None):
+    """
+    Whether a member is in the sample of the given rate (all members without a rate).
+
+    The choice hashes the file name of the member, the last part of its tar name, so the
+    same members are sampled by every stage and in every tar they are copied to.
+    """
+    if rate is None or rate >= 1:
+        return True
+    digest = hashlib.blake2b(name.split('/')[-1].encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') < rate * 2 ** 64
+
+
+def estimate(stage, items, seconds, rate=None, power=1):
+    """
+    Print the full-corpus count and time a sampled stage extrapolates to. The time scales
+    with the number of items to the given power, e.g. 2 for all-pairs comparisons.
+    """
+    if rate is None or rate >= 1:
+        return
+    full_items = items / rate
+    full_seconds = seconds / rate ** power
+    print(f'Sample rate {rate:g}: {stage} on the full corpus is about {full_items:,.0f} items '
+          f'and {full_seconds / 3600:.2f} hours')
+    telemetry.record(sample_rate=rate, estimated_items=full_items, estimated_seconds=full_seconds)
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+
+def geo_area(df):
+    """Geometric mean of the areas that only the first and only the second neighbour cover."""
+    return np.sqrt((df.sa1i / (df.denom + 100)) * (df.sa2i / (df.denom + 100)))
+
+
+def geo_count(df):
+    """Geometric mean of the numbers of cells that only the first and only the second neighbour cover."""
+    return np.sqrt(df.sa1i * df.sa2i)
+
+
+def geo_count_norm(df):
+    """geo_count relative to the size of the anchor."""
+    return np.sqrt(df.sa1i * df.sa2i) / (df.denom + 10)
+
+
+def pct_area(df):
+    """Percentage of the anchor covered by the neighbours together."""
+    return (df.sa1i + df.sa2i + df.inter) / (df.denom + 10)
+
+
+METRICS = {
+    'geo_area': geo_area,
+    'geo_count': geo_count,
+    'geo_count_norm': geo_count_norm,
+    'pct_area': pct_area,
+}
+
+
+def add_scores(df, metrics=('geo_area',), score=None):
+    """Add a column per metric to a frame of overlap counts, and set `score`, the column
+    triples are ranked by, to the score metric (the first metric by default)."""
+    for metric in metrics:
+        df[metric] = METRICS[metric](df).astype(np.float64)
+    df['score'] = df[score or metrics[0]]
+    return df
+
+
+def rescored_file(tripples):
+    """The default output of rescore for a triples file, e.g. ftripples.parquet -> ftripples_rescored.parquet."""
+    return os.path.splitext(tripples)[0] + '_rescored.parquet'
+
+
+def rescore(tripples, output_tripples=None, metrics=('geo_area',), score=None, top_n=None):
+    """
+    Recompute metrics from the counts stored in a triples file, without the token matrix,
+    and write them to output_tripples (rescored_file by default). With top_n only the best
+    top_n triples by the new score are kept, sorted.
+
+    Only triples in the file can be ranked again: a search that kept the best triples by
+    another metric (top_n, per_anchor or min_score) has already dropped the rest, so run
+    search without them to rescore the full candidate set.
+    """
+    import pyarrow.parquet as pq
+    from .collect import TopCollector
+
+    output_tripples = output_tripples or rescored_file(tripples)
+    tmp_file = output_tripples + '.tmp'
+    collector = TopCollector(tmp_file, n=top_n)
+    for batch in pq.ParquetFile(tripples).iter_batches(batch_size=1_000_000):
+        collector.add(add_scores(batch.to_pandas(), metrics, score))
+    df = collector.close()
+    os.replace(tmp_file, output_tripples)
+    if df is not None:
+        for i, j, k, score, *rest in df[:20].itertuples(index=False):
+            print(i, j, k, score, rest)
@@ -1,61 +1,118 @@
+import os
+import time
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from scipy.sparse import load_npz
+from scipy.sparse import csr_matrix
+
+from .collect import TopCollector
+from .corpus import open_corpus
+from .sample import estimate
+from .score import add_scores
+from . import telemetry
+
+COLUMNS = ['i', 'j', 'k', 'score', 'sa1i', 'sa2i', 'inter', 'denom', 'denom1', 'denom2']
+
+
+def load_top(top_file):
+    topo = np.load(top_file)
+    if 'arr_0' in topo:
+        return topo['arr_0']
+    return topo['top']
+
+
+def triple_counts(x, top, anchors, lengths=None):
+    """
+    Overlap counts for all neighbour pairs (j, jj), jj < j, of a block of anchor sheets.
+
+    The tokens an anchor shares with each of its neighbours are the rows of
+    P = x[neighbours] * x[anchors]. Renumbering the columns of P to positions within the
+    anchor's own tokens makes P @ P.T block diagonal, with one k x k block of pairwise
+    intersection sizes per anchor, so all pairs of the block come from one sparse product.
+    lengths are the row lengths of x (Corpus.lengths()), computed here when not given.
+    Returns a dict of arrays with the COLUMNS apart from score.
+    """
+    k = top.shape[1]
+    nb = top[anchors]
+    valid = nb >= 0
+    local, slot = np.nonzero(valid)
+    pair_nb = nb[local, slot]
+    if lengths is None:
+        lengths = np.diff(x.indptr)
+
+    xa = x[anchors]
+    shared = x[pair_nb].multiply(xa[local]).tocsr()
+    shared.sort_indices()
+    anchor_keys = np.repeat(np.arange(len(anchors), dtype=np.int64), np.diff(xa.indptr)) * x.shape[1] + xa.indices
+    pair_rows = np.repeat(local.astype(np.int64), np.diff(shared.indptr))
+    cols = np.searchsorted(anchor_keys, pair_rows * x.shape[1] + shared.indices)
+    p = csr_matrix((np.ones(len(cols), dtype=np.int32), cols, shared.indptr), shape=(len(pair_nb), len(anchor_keys)))
+    g = (p @ p.T).tocoo()
+
+    inter = np.zeros((len(anchors), k, k), dtype=np.int32)
+    inter[local[g.row], slot[g.row], slot[g.col]] = g.data
+    sa = inter[:, np.arange(k), np.arange(k)]
+
+    j_slot, jj_slot = np.tril_indices(k, -1)
+    a, pj = np.nonzero(valid[:, j_slot] & valid[:, jj_slot])
+    j, jj = j_slot[pj], jj_slot[pj]
+    intern = inter[a, j, jj]
+    return {
+        'i': anchors[a], 'j': nb[a, j], 'k': nb[a, jj],
+        'sa1i': sa[a, j] - intern, 'sa2i': sa[a, jj] - intern, 'inter': intern,
+        'denom': lengths[anchors[a]], 'denom1': lengths[nb[a, j]], 'denom2': lengths[nb[a, jj]],
+    }
+
+
+def score_block(x, top, anchors, metrics=('geo_area',), score=None, lengths=None):
+    df = pd.DataFrame(triple_counts(x, top, anchors, lengths))
+    df['score'] = 0.0
+    return add_scores(df[COLUMNS], metrics, score)
 
 
 def main(x_file='experiments/results/data.npz', top_file='experiments/results/top20.npz',
-         output_tripples='experiments/results/ftripples.parquet'):
-    k = 20
+         output_tripples='experiments/results/ftripples.parquet', chunksize=1000, n_jobs=None,
+         top_n=None, per_anchor=None, min_score=None, metrics=('geo_area',), score=None, sample_rate=None):
+    """Score all neighbour pairs of every sheet with each of the metrics, rank them by the score
+    metric and keep the best triples (see TopCollector). With top_n the output is sorted by
+    score; without it every triple is kept and written in anchor order, not sorted, so
+    readers that want the best triples select them by score (see compress.components_stream)."""
+    t0 = time.time()
     # Load from disk
     print('Loading')
-    x = load_npz(x_file)
-    topo = np.load(top_file)
-    top = topo['arr_0']
+    with telemetry.span('search', 'load') as span:
+        corpus = open_corpus(x_file)
+        x, lengths = corpus.matrix(), corpus.lengths()
+        top = load_top(top_file)
+        span.items = x.shape[0]
     print('Loaded', x.shape, top.shape)
 
-    x_lil = x.tolil()
-    x_set = [
-        set(row)
-        for row in x_lil.rows
-    ]
-
-    topa = top
-    scores = []
-
-    for i, xs in enumerate(tqdm(x_set)):
-        for j in range(k):
-            for jj in range(k):
-                if jj >= j:
-                    continue
-                j_ind = topa[i, j]
-                jj_ind = topa[i, jj]
-                sa1 = x_set[i] & x_set[j_ind]
-                sa2 = x_set[i] & x_set[jj_ind]
-                inter = (sa1 & sa2)
-                intern = len(inter)
-                sa1i = len(sa1 - inter)
-                sa2i = len(sa2 - inter)
-                denom1 = len(x_set[j_ind])
-                denom2 = len(x_set[jj_ind])
-                denom = len(x_set[i])
-                scores.append((i, j_ind, jj_ind, sa1i, sa2i, intern, denom, denom1, denom2))
-
-    # Sorting
-    ftripples = [(i, j, k,
-                  np.sqrt((sa1i / (denom + 100)) * (sa2i / (denom + 100))),  # Geometric mean of areas
-                  #np.sqrt((sa1i / (1)) * (sa2i / (1))),  # Geometric mean of nums
-                  #np.sqrt((sa1i / (1)) * (sa2i / (1))) / (denom + 10),  # Geometric mean of nums
-                  #(sa1i + sa2i + intern) / (denom + 10),                 # Percentage area
-                  sa1i, sa2i, intern, denom, denom1, denom2) for i ,j, k, sa1i, sa2i, intern, denom, denom1, denom2 in scores]
-
-    ftripples = sorted(ftripples, key=lambda x: x[3], reverse=True)
-    for i, j, k, score, *rest in ftripples[:20]:
-        print(i, j, k, score, rest)
-
-    df = pd.DataFrame(ftripples, columns=['i', 'j', 'k', 'score', 'sa1i', 'sa2i', 'inter', 'denom', 'denom1', 'denom2'])
-    df.to_parquet(output_tripples)
+    blocks = [np.arange(i, min(i + chunksize, top.shape[0])) for i in range(0, top.shape[0], chunksize)]
+    collector = TopCollector(output_tripples, n=top_n, per_anchor=per_anchor, min_score=min_score)
+    # The 20 best triples to print, when the output itself is not sorted
+    preview = TopCollector(n=20, per_anchor=per_anchor, min_score=min_score) if top_n is None else None
+    n_jobs = n_jobs or os.cpu_count()
+    with telemetry.span('search', 'triples') as span, ThreadPoolExecutor(max_workers=n_jobs) as pool, \
+            tqdm(total=len(blocks)) as progress:
+        # Submit a few blocks per worker at a time, so finished blocks do not pile up
+        for w in range(0, len(blocks), 2 * n_jobs):
+            for df in pool.map(lambda anchors: score_block(x, top, anchors, metrics, score, lengths), blocks[w:w + 2 * n_jobs]):
+                collector.add(df)
+                if preview is not None:
+                    preview.add(df)
+                progress.update()
+        df = collector.close()
+        if preview is not None:
+            df = preview.close()
+        span.items = collector.count
+        estimate('search', collector.count, time.time() - t0, sample_rate)
+    print('Triples scored', collector.count)
+
+    if df is not None:
+        for i, j, k, score, *rest in df[:20].itertuples(index=False):
+            print(i, j, k, score, rest)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,148 @@
+import json
+import os
+import resource
+import threading
+import time
+
+_config = {'file': None, 'run': None}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(telemetry_file, run=None):
+    """Append records to telemetry_file (None turns telemetry off), tagged with run, by default
+    the start time and pid of this process."""
+    if telemetry_file is not None and os.path.dirname(telemetry_file):
+        os.makedirs(os.path.dirname(telemetry_file), exist_ok=True)
+    _config['file'] = telemetry_file
+    _config['run'] = run or time.strftime('%Y%m%dT%H%M%S') + f'-{os.getpid()}'
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def io_bytes():
+    """(read_bytes, write_bytes) of this process from /proc/self/io, (0, 0) where that is missing."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return 0, 0
+    return int(counters['read_bytes']), int(counters['write_bytes'])
+
+
+def emit(record):
+    if _config['file'] is None:
+        return
+    record = {'run': _config['run'], 'time': time.time(), **record}
+    with _lock, open(_config['file'], 'a') as f:
+        f.write(json.dumps(record, default=float) + '\n')
+
+
+class Span:
+    """
+    Measure one stage or phase of a stage, as a context manager. Set items to the number of
+    items processed and parse to the seconds spent parsing, to get items/sec and the parse
+    share of the wall time. Peak RSS and bytes read and written are for the whole process,
+    so they include stages that run concurrently.
+    """
+
+    def __init__(self, stage, phase=None, **extra):
+        self.stage = stage
+        self.phase = phase
+        self.items = None
+        self.parse = None
+        self.extra = extra
+
+    def __enter__(self):
+        self.t0 = time.time()
+        self.io0 = io_bytes()
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _stack().remove(self)
+        wall = time.time() - self.t0
+        io1 = io_bytes()
+        emit({
+            'stage': self.stage,
+            'phase': self.phase,
+            'wall': wall,
+            'items': self.items,
+            'items_per_sec': self.items / wall if self.items is not None and wall > 0 else None,
+            'parse_share': self.parse / wall if self.parse is not None and wall > 0 else None,
+            'peak_rss': peak_rss(),
+            'read_bytes': io1[0] - self.io0[0],
+            'write_bytes': io1[1] - self.io0[1],
+            'error': exc_type.__name__ if exc_type is not None else None,
+            **self.extra,
+        })
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+def span(stage, phase=None, **extra):
+    return Span(stage, phase, **extra)
+
+
+def record(items=None, parse=None, **extra):
+    """Set the counts of the innermost span of this thread, if any, from code that does not
+    hold the span itself."""
+    spans = _stack()
+    if not spans:
+        return
+    if items is not None:
+        spans[-1].items = items
+    if parse is not None:
+        spans[-1].parse = parse
+    spans[-1].extra.update(extra)
+
+
+def load(telemetry_file):
+    import pandas as pd
+    with open(telemetry_file) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summary(df):
+    """Wall time, items/sec, parse share, peak RSS and bytes per stage and phase of one run."""
+    df = df.assign(phase=df.phase.fillna('-'))
+    return df.groupby(['stage', 'phase'], sort=False).agg(
+        wall=('wall', 'sum'), items=('items', 'sum'), items_per_sec=('items_per_sec', 'mean'),
+        parse_share=('parse_share', 'mean'), peak_rss=('peak_rss', 'max'),
+        read_bytes=('read_bytes', 'sum'), write_bytes=('write_bytes', 'sum'))
+
+
+def report(telemetry_file, run=None, base=None):
+    """
+    Summarise a run, the last one in the file by default. With base, a run id or 'previous',
+    the run is compared to it: the base values and the ratios of run over base are added for
+    wall time, items/sec and peak RSS.
+    """
+    df = load(telemetry_file)
+    runs = list(dict.fromkeys(df.run))
+    run = run or runs[-1]
+    current = summary(df[df.run == run])
+    print('Run', run)
+    if base is None:
+        print(current.to_string())
+        return current
+    if base == 'previous':
+        if runs.index(run) == 0:
+            raise ValueError(f'Run {run} is the first run in {telemetry_file}, there is no previous run')
+        base = runs[runs.index(run) - 1]
+    previous = summary(df[df.run == base])
+    print('Base', base)
+    diff = current[['wall', 'items_per_sec', 'peak_rss']].join(
+        previous[['wall', 'items_per_sec', 'peak_rss']], rsuffix='_base', how='outer')
+    for column in ['wall', 'items_per_sec', 'peak_rss']:
+        diff[column + '_ratio'] = diff[column] / diff[column + '_base']
+    print(diff.to_string())
+    return diff
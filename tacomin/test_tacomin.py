@@ -0,0 +1,681 @@
+"""Tests for the tacomin module."""
+import glob
+import io
+import os
+import tarfile
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import load_npz
+
+from . import archive, build_vocab, compare, compress, extract, fingerprint, index, ingest, pipeline, refine, sample, score, search, telemetry, verify
+from .build_vocab import pack, load_meta
+from .collect import TopCollector
+from .corpus import Corpus, open_corpus, save_corpus
+
+
+def make_tar(path, workbooks, copies=None):
+    """Write a tar with one xlsx member per workbook, each a list of sheets (lists of rows).
+    `copies` maps extra member names to the workbook whose bytes they copy."""
+    members = {}
+    with tarfile.open(path, mode='w') as tar:
+        for name, sheets in [*workbooks.items(), *(copies or {}).items()]:
+            if isinstance(sheets, str):
+                data = members[sheets]
+            else:
+                buffer = io.BytesIO()
+                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+                    for s, rows in enumerate(sheets):
+                        pd.DataFrame(rows).to_excel(writer, sheet_name=f'Sheet{s}', header=False, index=False)
+                data = members[name] = buffer.getvalue()
+            info = tarfile.TarInfo(f'cc-binaries/{name}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+WORKBOOKS = {
+    'a': [[['desc', 'a'], ['school', 'b'], ['1', '2']]],
+    'b': [[['desc', 'a'], ['school', 'b']], [['1', '2'], ['3', '4']]],
+    'c': [[['x', None], ['school', 'y']]],
+}
+
+
+def test_extract(tmp_path):
+    tar = make_tar(tmp_path / 'in.tar', WORKBOOKS)
+    extract.main(input_file=str(tar), output_data_file=str(tmp_path / 'data.npz'),
+                 output_meta_file=str(tmp_path / 'meta.pkl'), output_tall_dir=str(tmp_path / 'tall'))
+    x = load_npz(tmp_path / 'data.npz')
+    tall = pd.read_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    vocab = pd.read_parquet(tmp_path / 'tall' / 'vocab.parquet').set_index('word').id
+    assert x.shape[0] == 4
+    assert set(tall.fs) == {0, 1, 2, 3}
+    # The tall cells use the same ids as the matrix columns
+    for fs, cells in tall.groupby('fs'):
+        assert set(cells.v) <= set(x[fs].indices)
+    c = tall[tall.fs == 3]
+    assert list(zip(c.i, c.j, c.v)) == [(0, 0, vocab['x']), (1, 0, vocab['school']), (1, 1, vocab['y'])]
+
+
+def test_encode_sheet():
+    long = 'x' * 32_767
+    df = pd.DataFrame([[long, np.nan, 3], ['a', long + 'y', 2.5]])
+    vocab = {'nan': 0}
+    i, j, v, ids = extract.encode_sheet(df, vocab)
+    words = {w: n for n, w in vocab.items()}
+    assert [(a, b, words[c]) for a, b, c in zip(i, j, v)] == [(0, 0, 'x' * 20), (0, 2, '3.0'), (1, 0, 'a'), (1, 1, 'x' * 20), (1, 2, '2.5')]
+    assert ids.tolist() == sorted(vocab.values())
+
+
+def test_pack():
+    x = pack(None, [np.array([0, 2], dtype=np.int32), np.array([], dtype=np.int32), np.array([1, 2, 5], dtype=np.int32)])
+    assert x.shape == (3, 6)
+    assert x.indices.dtype == np.int32 and x.indptr.dtype == np.int32 and x.data.dtype == np.uint8
+    assert x.toarray().tolist() == [[1, 0, 1, 0, 0, 0], [0, 0, 0, 0, 0, 0], [0, 1, 1, 0, 0, 1]]
+
+
+def test_extract_dedupe(tmp_path):
+    workbooks = {**WORKBOOKS, 'd': [[['q']], WORKBOOKS['c'][0]]}
+    tar = make_tar(tmp_path / 'in.tar', workbooks, copies={'e': 'b'})
+    extract.main(input_file=str(tar), output_data_file=str(tmp_path / 'data.npz'),
+                 output_meta_file=str(tmp_path / 'meta.pkl'), output_tall_dir=str(tmp_path / 'tall'))
+    vocab, words_member, duplicates = load_meta(tmp_path / 'meta.pkl')
+    assert words_member == [('a', 0), ('b', 0), ('b', 1), ('c', 0), ('d', 0)]
+    assert duplicates == {('d', 1): 3, ('e', 0): 1, ('e', 1): 2}
+    assert load_npz(tmp_path / 'data.npz').shape[0] == 5
+
+
+def clustered_matrix(n=500, vocab=3000, cluster=10, seed=0):
+    """Token matrix of n sheets in clusters of near duplicates."""
+    rng = np.random.default_rng(seed)
+    bases = [rng.choice(vocab, 60, replace=False) for _ in range(n // cluster)]
+    words = []
+    for i in range(n):
+        base = bases[i % len(bases)]
+        words.append(np.unique(np.concatenate([base[rng.random(len(base)) < 0.8], rng.choice(vocab, 10)])).astype(np.int32))
+    return pack(None, words)
+
+
+def test_topk_segments():
+    rows = np.array([0, 0, 0, 2, 2])
+    cols = np.array([1, 2, 3, 0, 1])
+    scores = np.array([0.5, 0.9, 0.1, 0.2, 0.3])
+    top, top_scores = compare.topk_segments(rows, cols, scores, 3, 2)
+    assert top.tolist() == [[2, 1], [-1, -1], [1, 0]]
+    assert top_scores[0].tolist() == [np.float32(0.9), np.float32(0.5)]
+
+
+def test_lsh_recall():
+    xd = compare.tfidf(clustered_matrix())
+    top, _ = compare.lsh_topk(xd, 9, num_perm=64, bands=32)
+    assert compare.recall(xd, top, 9, sample=100) > 0.9
+    with pytest.raises(ValueError):
+        compare.main('data.npz', 'top{k}.npz', method='lsh', num_perm=16, bands=32)
+    with pytest.raises(ValueError):
+        compare.main('data.npz', 'top{k}.npz', method='lsh', limit=10)
+
+
+def test_blocked_topk():
+    xd = compare.tfidf(clustered_matrix(n=200))
+    top, top_scores = compare.blocked_topk(xd, 5, chunksize=30, n_jobs=4)
+    dense = (xd @ xd.T).toarray()
+    np.fill_diagonal(dense, -np.inf)
+    for i in range(dense.shape[0]):
+        assert i not in top[i]
+        assert np.allclose(top_scores[i], np.sort(dense[i])[::-1][:5])
+        assert np.allclose(dense[i, top[i]], top_scores[i])
+
+
+def test_outofcore_topk(tmp_path):
+    x = clustered_matrix(n=200)
+    save_corpus(x, tmp_path / 'data')
+    top, top_scores = compare.outofcore_topk(Corpus(tmp_path / 'data'), 5, tmp_path / 'blocks', block_size=30, shard_size=70)
+    expected, expected_scores = compare.blocked_topk(compare.tfidf(x), 5)
+    assert np.allclose(top_scores, expected_scores, atol=1e-4)
+    assert (top == expected).mean() > 0.95  # up to ties
+    # A finished run is picked up again without recomputation
+    assert np.load(tmp_path / 'blocks' / 'done.npy').all()
+    again, _ = compare.outofcore_topk(Corpus(tmp_path / 'data'), 5, tmp_path / 'blocks', block_size=30, shard_size=70)
+    assert (again == top).all()
+
+    # Blocks of another corpus with the same shape are not resumed
+    other = x[::-1].tocsr()
+    save_corpus(other, tmp_path / 'data')
+    top, top_scores = compare.outofcore_topk(Corpus(tmp_path / 'data'), 5, tmp_path / 'blocks', block_size=30, shard_size=70)
+    _, expected_scores = compare.blocked_topk(compare.tfidf(other), 5)
+    assert np.allclose(top_scores, expected_scores, atol=1e-4)
+
+    # compare removes the blocks once the top file is written
+    compare.main(str(tmp_path / 'data.npz'), str(tmp_path / 'top{k}.npz'), top_k=5, method='outofcore', block_size=30, shard_size=70)
+    assert np.load(tmp_path / 'top5.npz')['top'].shape == (200, 5)
+    assert not os.path.exists(tmp_path / 'top5_blocks')
+
+
+def test_triple_counts():
+    x = clustered_matrix(n=100)
+    top, _ = compare.blocked_topk(compare.tfidf(x), 4)
+    # Padding on scored anchors: sheet 5 keeps two neighbours and sheet 10 three
+    top[5, 2:] = -1
+    top[10, 3:] = -1
+    df = search.score_block(x, top, np.arange(20, dtype=np.int64) * 5 % 100)
+    assert (df.i == 5).sum() == 1 and (df.i == 10).sum() == 3 and (df[['j', 'k']] >= 0).all().all()
+    x_set = [set(x[i].indices) for i in range(x.shape[0])]
+    expected = []
+    for i in np.arange(20) * 5 % 100:
+        for j in range(4):
+            for jj in range(j):
+                j_ind, jj_ind = top[i, j], top[i, jj]
+                if j_ind < 0 or jj_ind < 0:
+                    continue
+                sa1, sa2 = x_set[i] & x_set[j_ind], x_set[i] & x_set[jj_ind]
+                inter = sa1 & sa2
+                expected.append((i, j_ind, jj_ind, len(sa1 - inter), len(sa2 - inter), len(inter),
+                                 len(x_set[i]), len(x_set[j_ind]), len(x_set[jj_ind])))
+    cols = ['i', 'j', 'k', 'sa1i', 'sa2i', 'inter', 'denom', 'denom1', 'denom2']
+    assert [tuple(r) for r in df[cols].itertuples(index=False)] == expected
+    assert list(df.columns) == search.COLUMNS + ['geo_area']
+
+
+def test_top_collector(tmp_path):
+    rng = np.random.default_rng(0)
+    dfs = [pd.DataFrame({'i': np.repeat(np.arange(b * 10, b * 10 + 10), 5), 'score': rng.random(50)}) for b in range(20)]
+    everything = pd.concat(dfs, ignore_index=True)
+
+    collector = TopCollector(tmp_path / 'top.parquet', n=30, min_score=0.1)
+    for df in dfs:
+        collector.add(df)
+    top = collector.close()
+    assert top.score.tolist() == sorted(everything.score, reverse=True)[:30]
+    assert pd.read_parquet(tmp_path / 'top.parquet').equals(top)
+
+    collector = TopCollector(tmp_path / 'anchor.parquet', per_anchor=2)
+    for df in dfs:
+        collector.add(df)
+    assert collector.close() is None
+    per_anchor = pd.read_parquet(tmp_path / 'anchor.parquet')
+    assert len(per_anchor) == 400
+    assert per_anchor.groupby('i').score.min().tolist() == everything.groupby('i').score.nlargest(2).groupby('i').min().tolist()
+
+
+def test_subset():
+    x = clustered_matrix(n=100)
+    top, _ = compare.blocked_topk(compare.tfidf(x), 4)
+    scores = refine.subset(top, x, k=4, n_contains=20)
+    expected = sorted((len(set(x[i].indices) & set(x[j].indices)) for i in range(100) for j in top[i]), reverse=True)
+    assert sorted(scores.sa, reverse=True) == [sa for sa in expected if sa >= 20]
+    assert scores.i.is_monotonic_increasing
+    assert refine.subset(top, x, k=4, n_contains=20, top_n=5).sa.tolist() == [sa for sa in expected if sa >= 20][:5]
+
+
+def test_rescore(tmp_path):
+    x = clustered_matrix(n=100)
+    top, _ = compare.blocked_topk(compare.tfidf(x), 4)
+    df = search.score_block(x, top, np.arange(100), metrics=('geo_area', 'pct_area'))
+    assert np.allclose(df.score, np.sqrt((df.sa1i / (df.denom + 100)) * (df.sa2i / (df.denom + 100))))
+    df.to_parquet(tmp_path / 'ftripples.parquet')
+    score.rescore(str(tmp_path / 'ftripples.parquet'), metrics=('geo_count', 'pct_area'), score='pct_area', top_n=10)
+    rescored = pd.read_parquet(tmp_path / 'ftripples_rescored.parquet')
+    assert rescored.score.tolist() == sorted(df.pct_area, reverse=True)[:10]
+    assert np.allclose(rescored.geo_count, np.sqrt(rescored.sa1i * rescored.sa2i))
+    # The input is kept, and without top_n every triple is rescored
+    assert pd.read_parquet(tmp_path / 'ftripples.parquet').equals(df)
+    score.rescore(str(tmp_path / 'ftripples.parquet'), str(tmp_path / 'all.parquet'), metrics=('pct_area',))
+    assert np.allclose(pd.read_parquet(tmp_path / 'all.parquet').score, df.pct_area)
+
+
+def tall_frame(sheets):
+    """Tall (fs, i, j, v) cells from {fs: 2d array of ids}, with 0 as the empty cell."""
+    frames = []
+    for fs, grid in sheets.items():
+        i, j = np.nonzero(grid)
+        frames.append(pd.DataFrame({'fs': np.int32(fs), 'i': i.astype(np.int16), 'j': j.astype(np.uint8),
+                                    'v': np.asarray(grid)[i, j].astype(np.int32)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def concat_sheets():
+    """Sheet 0 is sheet 1 stacked on top of sheet 2, sheet 3 is sheet 1 next to sheet 4, 5 is unrelated."""
+    top = np.arange(1, 13).reshape(3, 4)
+    bottom = np.arange(13, 21).reshape(2, 4)
+    right = np.arange(21, 27).reshape(3, 2)
+    return {0: np.vstack([top, bottom]), 1: top, 2: bottom, 3: np.hstack([top, right]), 4: right,
+            5: np.arange(100, 120).reshape(4, 5)}
+
+
+def test_moves(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    scores = pd.DataFrame({'i': [0, 0, 2, 3, 3, 5], 'j': [1, 2, 0, 1, 4, 0], 'sa': [12, 8, 8, 12, 6, 0]})
+    files = refine.moves(scores, str(tmp_path / 'tall'), str(tmp_path / 'moves'), n_contains=5, n_move_size=4, batch_size=2)
+    df = pd.read_parquet(tmp_path / 'moves').sort_values(['afs', 'bfs'], ignore_index=True)
+    assert len(glob.glob(files)) == 2
+    assert df[['afs', 'bfs', 'di', 'dj', 'move_size']].values.tolist() == [
+        [0, 1, 0, 0, 12], [0, 2, 3, 0, 8], [1, 3, 0, 0, 12], [3, 4, 0, 4, 6]]
+
+
+def test_moves_value_pruning(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    sheets = concat_sheets()
+    sheets[6] = np.full((3, 3), 100)
+    tall_frame(sheets).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    value_df = np.bincount(tall_frame(sheets).drop_duplicates(['fs', 'v']).v, minlength=120)
+    value_df[1:5] = 7  # the first row of sheet 1 is everywhere
+    values = refine.value_weights(value_df, 7, max_df=0.5)
+    assert set(values.v) == set(range(5, 27)) | set(range(100, 120))
+    scores = pd.DataFrame({'i': [0, 5], 'j': [1, 6], 'sa': [12, 1]})
+    refine.moves(scores, str(tmp_path / 'tall'), str(tmp_path / 'moves'), n_contains=1, n_move_size=0,
+                 values=values, max_value_cells=2)
+    df = pd.read_parquet(tmp_path / 'moves')
+    assert df[['afs', 'bfs', 'di', 'dj', 'move_size']].values.tolist() == [[0, 1, 0, 0, 8]]
+    assert np.isclose(df.move_weight[0], 8 * np.log(7 / 3))
+
+
+def test_concat(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    scores = pd.DataFrame({'i': [0, 0, 3, 3, 5], 'j': [1, 2, 1, 4, 0], 'sa': [12, 8, 12, 6, 1]})
+    files = refine.moves(scores, str(tmp_path / 'tall'), str(tmp_path / 'moves'), n_contains=1, n_move_size=4)
+    df = refine.concat(files)
+    assert df[['fs', 'source1', 'source2', 'axis']].values.tolist() == [[0, 1, 2, 'v'], [3, 1, 4, 'h']]
+    assert df[['maxi', 'mini']].values[0].tolist() == [2, 3]
+    assert df[['maxj', 'minj']].values[1].tolist() == [3, 4]
+    assert refine.concat(pd.read_parquet(tmp_path / 'moves')).equals(df)
+
+
+def test_index(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    index.build(str(tmp_path / 'tall'), str(tmp_path / 'index.duckdb'))
+    con = index.connect(str(tmp_path / 'index.duckdb'))
+    positions, df = index.sheets_with_value(con, 13)
+    assert df == 2
+    assert positions.values.tolist() == [[0, 3, 0], [2, 0, 0]]
+    histogram = index.offset_histogram(con, 0, 2)
+    assert histogram.values[0].tolist() == [3, 0, 8]
+    assert con.sql('select file, row_group, fs_min, fs_max from sheet_location').fetchall() == [('df_0000.parquet', 0, 0, 5)]
+    con.close()
+
+    scores = pd.DataFrame({'i': [0, 0, 3, 3], 'j': [1, 2, 1, 4], 'sa': [12, 8, 12, 6]})
+    files = refine.moves(scores, str(tmp_path / 'tall'), str(tmp_path / 'moves'), n_contains=1, n_move_size=4, n_jobs=2,
+                         batch_size=1, index_file=str(tmp_path / 'index.duckdb'))
+    assert len(refine.concat(files)) == 2
+
+
+def test_fingerprint_moves(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    # Fingerprints of a tall file that is gone are removed
+    os.makedirs(tmp_path / 'fp')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'fp' / 'fp_0001.parquet')
+    fingerprint.build(str(tmp_path / 'tall'), str(tmp_path / 'fp'))
+    assert os.listdir(tmp_path / 'fp') == ['fp_0000.parquet']
+    fp = pd.read_parquet(tmp_path / 'fp' / 'fp_0000.parquet')
+    assert len(fp[fp.fs == 1]) == 6  # 2x2 blocks in a 3x4 sheet
+    scores = pd.DataFrame({'i': [0, 0, 3, 3], 'j': [1, 2, 1, 4], 'sa': [12, 8, 12, 6]})
+    files = refine.moves(scores, str(tmp_path / 'tall'), str(tmp_path / 'moves'), n_contains=1, n_move_size=1,
+                         fingerprint_dir=str(tmp_path / 'fp'))
+    df = pd.read_parquet(tmp_path / 'moves').sort_values(['afs', 'bfs'], ignore_index=True)
+    assert df[['afs', 'bfs', 'di', 'dj', 'move_size']].values.tolist() == [
+        [0, 1, 0, 0, 6], [0, 2, 3, 0, 3], [1, 3, 0, 0, 6], [3, 4, 0, 4, 2]]
+    assert df[['mini1', 'minj1', 'maxi1', 'maxj1']].values[1].tolist() == [3, 0, 4, 3]
+    assert refine.concat(files)[['fs', 'source1', 'source2', 'axis']].values.tolist() == [[0, 1, 2, 'v'], [3, 1, 4, 'h']]
+
+
+def test_archive(tmp_path):
+    tar = make_tar(tmp_path / 'in.tar', WORKBOOKS)
+    archive.pack(str(tar), str(tmp_path / 'members.zar'))
+    members = archive.Archive(str(tmp_path / 'members.zar'))
+    with tarfile.open(tar) as t:
+        assert members.read('cc-binaries/b') == t.extractfile('cc-binaries/b').read()
+        assert members.read('c') == t.extractfile('cc-binaries/c').read()
+    data, sheetnr = members.read_fs(2, [('a', 0), ('b', 0), ('b', 1)])
+    assert data == members.read('b') and sheetnr == 1
+
+    extract.main(input_file=str(tar), output_data_file=str(tmp_path / 'data.npz'),
+                 output_meta_file=str(tmp_path / 'meta.pkl'), output_tall_dir=str(tmp_path / 'tall'))
+    pd.DataFrame({'i': [1], 'j': [3], 'k': [2], 'score': [0.5]}).to_parquet(tmp_path / 'ftripples.parquet')
+    compress.main(str(tar), str(tmp_path / 'meta.pkl'), str(tmp_path / 'ftripples.parquet'), str(tmp_path / 'out.tar'),
+                  archive_file=str(tmp_path / 'members.zar'))
+    with tarfile.open(tmp_path / 'out.tar') as t:
+        assert sorted(t.getnames()) == ['cc-binaries/b', 'cc-binaries/c']
+
+
+def test_to_parquet(tmp_path):
+    tar = make_tar(tmp_path / 'in.tar', WORKBOOKS)
+    extract.main(input_file=str(tar), output_data_file=str(tmp_path / 'data.npz'),
+                 output_meta_file=str(tmp_path / 'meta.pkl'), output_tall_dir=str(tmp_path / 'tall'))
+    compress.to_parquet(str(tar), str(tmp_path / 'meta.pkl'), str(tmp_path / 'tall2'))
+    expected = pd.read_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    assert pd.read_parquet(tmp_path / 'tall2' / 'df_0000.parquet').equals(expected)
+    assert expected.dtypes.tolist() == [np.int32, np.int16, np.uint8, np.int32]
+
+
+def test_cell_ids_match_matrix(tmp_path):
+    # An int column that only turns float past row 100 must encode the same in every stage
+    column = [[n] for n in range(150)] + [[0.5]]
+    tar = make_tar(tmp_path / 'in.tar', {**WORKBOOKS, 'f': [column]})
+    build_vocab.main(str(tar), str(tmp_path / 'data.npz'), str(tmp_path / 'meta.pkl'))
+    x = load_npz(tmp_path / 'data.npz')
+    compress.to_parquet(str(tar), str(tmp_path / 'meta.pkl'), str(tmp_path / 'tall'))
+    extract.main(input_file=str(tar), output_data_file=str(tmp_path / 'data2.npz'),
+                 output_meta_file=str(tmp_path / 'meta2.pkl'), output_tall_dir=str(tmp_path / 'tall2'))
+    for tall_dir, matrix in [('tall', x), ('tall2', load_npz(tmp_path / 'data2.npz'))]:
+        tall = pd.read_parquet(glob.glob(str(tmp_path / tall_dir / 'df_*.parquet')))
+        for fs, cells in tall.groupby('fs'):
+            assert set(cells.v) <= set(matrix[fs].indices)
+
+
+def test_to_tall(tmp_path):
+    # Old wide layout, with 0 the id of 'nan'
+    os.makedirs(tmp_path / 'wide')
+    sheets = concat_sheets()
+    for n, part in enumerate([[3, 0, 5], [1, 4, 2]]):
+        frames = []
+        for fs in part:
+            grid = np.zeros((sheets[fs].shape[0], 100), dtype=int)
+            grid[:, :sheets[fs].shape[1]] = sheets[fs]
+            df = pd.DataFrame(grid, columns=[str(c) for c in range(100)])
+            df.insert(0, 'i', range(len(df)))
+            frames.append(df.assign(f='x', s=0, fs=fs, rows=len(df), cols=sheets[fs].shape[1]))
+        pd.concat(frames).to_parquet(tmp_path / 'wide' / f'df_{n:04d}.parquet')
+    pd.DataFrame({'word': ['nan', '1'], 'id': [0, 1]}).to_parquet(tmp_path / 'wide' / 'vocab.parquet')
+
+    compress.to_tall(str(tmp_path / 'wide'), str(tmp_path / 'tall'), sheets_per_file=4, row_group_size=10)
+    expected = tall_frame(sheets).sort_values(['fs', 'i', 'j'], ignore_index=True)
+    result = pd.read_parquet(sorted(glob.glob(str(tmp_path / 'tall' / 'df_*.parquet'))))
+    assert result.equals(expected)
+    manifest = pd.read_parquet(tmp_path / 'tall' / 'manifest.parquet')
+    assert manifest.file.unique().tolist() == ['df_0000.parquet', 'df_0001.parquet']
+    assert (manifest.fs_min.to_numpy()[1:] >= manifest.fs_max.to_numpy()[:-1]).all()
+    assert os.path.exists(tmp_path / 'tall' / 'vocab.parquet')
+    assert index.tall_source(str(tmp_path / 'tall'), [5]) == f"read_parquet({[str(tmp_path / 'tall' / 'df_0001.parquet')]!r})"
+
+    # In place, on tall input
+    compress.to_tall(str(tmp_path / 'tall'), str(tmp_path / 'tall'), sheets_per_file=2, row_group_size=10)
+    result = pd.read_parquet(sorted(glob.glob(str(tmp_path / 'tall' / 'df_*.parquet'))))
+    assert result.equals(expected)
+    assert sorted(os.listdir(tmp_path / 'tall')) == ['df_0000.parquet', 'df_0001.parquet', 'df_0002.parquet',
+                                                     'manifest.parquet', 'vocab.parquet']
+
+    # An input without parquet files leaves the output alone
+    with pytest.raises(ValueError):
+        compress.to_tall(str(tmp_path / 'missing'), str(tmp_path / 'tall'))
+    assert len(glob.glob(str(tmp_path / 'tall' / 'df_*.parquet'))) == 3
+
+
+def test_components(tmp_path):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    rng = np.random.default_rng(0)
+    n, m = 500, 300
+    df = pd.DataFrame({'i': rng.integers(0, n, m), 'j': rng.integers(0, n, m), 'k': rng.integers(0, n, m),
+                       'score': rng.random(m)}).sort_values('score', ascending=False, ignore_index=True)
+    tripples = str(tmp_path / 'tripples.parquet')
+    df.to_parquet(tripples, row_group_size=50)
+
+    best = compress.components_stream(tripples, str(tmp_path / 'components.parquet'),
+                                      labelled_file=str(tmp_path / 'labelled.parquet'), batch_size=64)
+    edges = np.concatenate([df[['i', 'j']].to_numpy(), df[['i', 'k']].to_numpy()])
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    expected = df.assign(component=labels[df.i]).drop_duplicates('component')
+    assert sorted(best.score) == sorted(expected.score)
+    assert len(pd.read_parquet(tmp_path / 'labelled.parquet')) == m
+    assert (best.score.to_numpy() == compress.components(df.copy(), n_top=m).score.to_numpy()).all()
+
+    # n_top takes the best triples by score, also from a file that is not sorted
+    top_best = compress.components_stream(tripples, str(tmp_path / 'components.parquet'), n_top=100, batch_size=64)
+    df.sample(frac=1, random_state=0).to_parquet(tmp_path / 'shuffled.parquet', row_group_size=50)
+    shuffled_best = compress.components_stream(str(tmp_path / 'shuffled.parquet'), str(tmp_path / 'components.parquet'),
+                                               labelled_file=str(tmp_path / 'labelled.parquet'), n_top=100, batch_size=64)
+    assert shuffled_best.score.tolist() == top_best.score.tolist()
+    assert sorted(pd.read_parquet(tmp_path / 'labelled.parquet').score) == sorted(df.score[:100])
+
+    # A hub sheet in every triple is one component, linked in a few rounds
+    n = 20_000
+    parent = compress.grow(np.zeros(0, dtype=np.int64), n + 1)
+    compress.union(parent, np.full(n, n // 2), np.delete(np.arange(n + 1), n // 2))
+    assert (compress.find(parent, np.arange(n + 1)) == 0).all()
+
+    # No triples at all
+    df.head(0).to_parquet(tripples)
+    best = compress.components_stream(tripples, str(tmp_path / 'components.parquet'))
+    assert len(best) == 0 and list(pd.read_parquet(tmp_path / 'components.parquet').columns) == list(df.columns) + ['component']
+
+
+def test_pipeline(tmp_path):
+    ran = []
+
+    def writer(name, inputs, output):
+        def run():
+            ran.append(name)
+            content = ''.join(open(p).read() for p in inputs)
+            with open(output, 'w') as f:
+                f.write(content + name)
+        return run
+
+    source = tmp_path / 'source.txt'
+    source.write_text('x')
+    a, b, c = (str(tmp_path / f'{n}.txt') for n in 'abc')
+
+    def stages(param):
+        return [
+            pipeline.Stage('a', writer('a', [source], a), [str(source)], [a]),
+            pipeline.Stage('b', writer('b', [a], b), [a], [b], {'param': param}),
+            pipeline.Stage('c', writer('c', [a], c), [a], [c]),
+        ]
+
+    stamp_dir = str(tmp_path / '.tac')
+    assert sorted(pipeline.Pipeline(stages(1), stamp_dir).run(['b', 'c'])) == ['a', 'b', 'c']
+    assert ran.index('a') == 0 and open(b).read() == 'xab'
+    assert pipeline.Pipeline(stages(1), stamp_dir).run(['b', 'c']) == []
+    # A parameter only reruns its own stage, a changed source reruns everything downstream
+    assert pipeline.Pipeline(stages(2), stamp_dir).run(['b', 'c']) == ['b']
+    assert pipeline.Pipeline(stages(2), stamp_dir).run(['c'], force=['c']) == ['c']
+    source.write_text('yy')
+    assert sorted(pipeline.Pipeline(stages(2), stamp_dir).run(['c'])) == ['a', 'c']
+    os.remove(c)
+    assert pipeline.Pipeline(stages(2), stamp_dir).run(['c']) == ['c']
+    # A stage that does not write its outputs is not stamped as done
+    lazy = [*stages(2)[:2], pipeline.Stage('c', lambda: None, [a], [c])]
+    os.remove(c)
+    with pytest.raises(RuntimeError):
+        pipeline.Pipeline(lazy, stamp_dir).run(['c'], force=['c'])
+    assert not os.path.exists(os.path.join(stamp_dir, 'c.json'))
+    p = pipeline.Pipeline(stages(2), stamp_dir)
+    assert p.downstream('a') == {'b', 'c'}
+    p.invalidate(p.downstream('a'))
+    assert sorted(p.run(['b', 'c'])) == ['b', 'c']
+
+
+def test_run(tmp_path):
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    make_tar(tmp_path / 'in.tar', WORKBOOKS)
+    paths = {'--input-tar': 'in.tar', '--output-data': 'data.npz', '--output-meta': 'meta.pkl', '--output-top': 'top{k}.npz',
+             '--output-tripples': 'tripples.parquet', '--top-tar': 'top.tar', '--parquet-tall-dir': 'tall',
+             '--index-file': 'index.duckdb', '--fingerprint-dir': 'fingerprints', '--moves-dir': 'moves',
+             '--verify-output': 'verified.parquet', '--stamp-dir': '.tac', '--telemetry-file': 'telemetry.jsonl'}
+    argv = [sys.executable, 'tac.py', 'run', '--targets', 'refine,verify', '--compare-k', '3', '--n-contains', '1',
+            *(a for flag, name in paths.items() for a in (flag, str(tmp_path / name)))]
+    out = subprocess.run(argv, cwd=root, capture_output=True, text=True, check=True).stdout
+    assert 'Stage tall done' in out and out.index('Stage tall done') < out.index('Stage refine done')
+    assert pd.read_parquet(tmp_path / 'tall' / 'manifest.parquet').file.tolist() == ['df_0000.parquet']
+    out = subprocess.run(argv, cwd=root, capture_output=True, text=True, check=True).stdout
+    assert ' done in ' not in out and out.count('up to date') == 8
+
+
+def test_telemetry(tmp_path):
+    from scipy.sparse import save_npz
+    # The directory of the telemetry file is created
+    telemetry_file = str(tmp_path / 'results' / 'telemetry.jsonl')
+    x = clustered_matrix(300, 2000, 10)
+    save_npz(tmp_path / 'data.npz', x)
+    for run in ['a', 'b']:
+        telemetry.configure(telemetry_file, run=run)
+        with telemetry.span('compare'):
+            compare.main(str(tmp_path / 'data.npz'), str(tmp_path / 'top{k}.npz'), top_k=5, n_jobs=2)
+    telemetry.configure(None)
+
+    df = telemetry.load(telemetry_file)
+    topk = df[(df.run == 'b') & (df.phase == 'topk')].iloc[0]
+    assert topk.stage == 'compare' and topk['items'] == 300 and topk.items_per_sec > 0 and topk.peak_rss > 0
+    assert list(df[df.run == 'a'].phase.fillna('-')) == ['load', 'topk', 'save', '-']
+    diff = telemetry.report(telemetry_file, base='previous')
+    assert len(diff) == 4 and (diff.wall_ratio > 0).all()
+    with pytest.raises(ValueError):
+        telemetry.report(telemetry_file, run='a', base='previous')
+
+
+def test_cli_import_budget(tmp_path):
+    import subprocess
+    import sys
+    import time
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    heavy = {'numpy', 'pandas', 'scipy', 'duckdb', 'pyarrow', 'xlrd', 'tqdm'}
+
+    def loaded(*argv):
+        """The heavy modules tac.py loads to run a command."""
+        code = ("import runpy, sys; sys.argv = ['tac.py'] + sys.argv[1:]\n"
+                "try:\n    runpy.run_path('tac.py', run_name='__main__')\nexcept SystemExit:\n    pass\n"
+                f"print(sorted({heavy!r} & set(sys.modules)))")
+        out = subprocess.run([sys.executable, '-c', code, *argv, '--telemetry-file', str(tmp_path / 'telemetry.jsonl')],
+                             cwd=root, capture_output=True, text=True, check=True)
+        return set(eval(out.stdout.strip().splitlines()[-1])), out.stdout
+
+    modules, help_text = loaded('--help')
+    assert modules == set()
+    t0 = time.time()
+    subprocess.run([sys.executable, 'tac.py', '--help'], cwd=root, capture_output=True, check=True)
+    assert time.time() - t0 < 1.0
+    from . import score
+    assert all(metric in help_text for metric in score.METRICS)
+
+    # Commands only load the dependencies of the functions they run
+    os.makedirs(tmp_path / 'tall')
+    tall_frame(concat_sheets()).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    modules, _ = loaded('tall', '--parquet-dir', str(tmp_path / 'tall'), '--parquet-tall-dir', str(tmp_path / 'clustered'))
+    assert os.path.exists(tmp_path / 'clustered' / 'manifest.parquet') and not modules & {'scipy', 'xlrd'}
+    pd.DataFrame({'i': [0, 3], 'j': [1, 1], 'k': [2, 4], 'score': [2., 1.]}).to_parquet(tmp_path / 'tripples.parquet')
+    modules, _ = loaded('components', '--output-tripples', str(tmp_path / 'tripples.parquet'),
+                        '--output-components', str(tmp_path / 'components.parquet'))
+    assert os.path.exists(tmp_path / 'components.parquet') and not modules & {'scipy', 'xlrd', 'duckdb'}
+    tar = make_tar(tmp_path / 'in.tar', WORKBOOKS)
+    build_vocab.main(str(tar), str(tmp_path / 'data.npz'), str(tmp_path / 'meta.pkl'))
+    modules, _ = loaded('compress', '--input-tar', str(tar), '--output-meta', str(tmp_path / 'meta.pkl'),
+                        '--output-tripples', str(tmp_path / 'tripples.parquet'), '--top-tar', str(tmp_path / 'top.tar'))
+    assert os.path.exists(tmp_path / 'top.tar') and 'duckdb' not in modules
+
+
+def test_corpus(tmp_path):
+    from scipy.sparse import save_npz
+    x = clustered_matrix(n=50)
+    save_npz(tmp_path / 'data.npz', x)
+    corpus = open_corpus(str(tmp_path / 'data.npz'))
+    assert os.path.exists(tmp_path / 'data' / 'indices.npy') and len(corpus) == 50
+    m = corpus.matrix()
+    assert np.shares_memory(m.indices, corpus.indices) and (m != x).nnz == 0
+    assert (corpus.lengths() == np.diff(x.indptr)).all()
+
+
+def test_update_topk():
+    x = clustered_matrix(n=300)
+    xd = compare.tfidf(x)
+    n_old, k = 240, 5
+    old = xd[:n_old]
+    top, top_scores = compare.exact_topk(old, np.arange(n_old), k)
+    top, top_scores, anchors = ingest.update_topk(xd, top, top_scores, np.arange(n_old, 300), k)
+    expected, expected_scores = compare.blocked_topk(xd, k)
+    assert np.allclose(top_scores, expected_scores)
+    assert set(anchors) >= set(range(n_old, 300)) and len(anchors) < 300
+
+
+def test_ingest(tmp_path):
+    files = {name: str(tmp_path / name) for name in ['data.npz', 'meta.pkl', 'top{k}.npz', 'tripples.parquet']}
+    build_vocab.main(str(make_tar(tmp_path / 'in.tar', WORKBOOKS)), files['data.npz'], files['meta.pkl'])
+    compare.main(files['data.npz'], files['top{k}.npz'], top_k=3)
+    search.main(files['data.npz'], files['top{k}.npz'].format(k=3), files['tripples.parquet'])
+
+    new = {'a': WORKBOOKS['a'], 'd': [[['desc', 'a'], ['school', 'b'], ['5', '6']]]}
+    os.makedirs(tmp_path / 'top3_blocks')
+    ingest.main(str(make_tar(tmp_path / 'new.tar', new)), files['data.npz'], files['meta.pkl'], files['top{k}.npz'],
+                files['tripples.parquet'], top_k=3)
+    vocab, words_member, _ = load_meta(files['meta.pkl'])
+    x = load_npz(files['data.npz'])
+    top = np.load(files['top{k}.npz'].format(k=3))['top']
+    # Member a was in the corpus already, only the sheet of d is added
+    assert words_member[-1] == ('d', 0) and x.shape == (5, len(vocab)) and top.shape == (5, 3)
+    corpus = Corpus(tmp_path / 'data')
+    assert (corpus.matrix()[4].indices == x[4].indices).all()
+    assert (corpus.document_frequencies() == np.load(files['top{k}.npz'].format(k=3))['df']).all()
+    assert 0 in top[4] and not os.path.exists(tmp_path / 'top3_blocks')
+    assert 4 in set(pd.read_parquet(files['tripples.parquet']).i)
+
+    # The new member is read from the ingest tar
+    compress.main([str(tmp_path / 'in.tar'), str(tmp_path / 'new.tar')], files['meta.pkl'], files['tripples.parquet'],
+                  str(tmp_path / 'top.tar'))
+    with tarfile.open(tmp_path / 'top.tar') as t:
+        names = t.getnames()
+    assert 'cc-binaries/d' in names and len(names) == len(set(names))
+    compress.to_parquet(str(tmp_path / 'top.tar'), files['meta.pkl'], str(tmp_path / 'tall'))
+    assert 4 in set(pd.read_parquet(glob.glob(str(tmp_path / 'tall' / 'df_*.parquet'))).fs)
+
+
+def test_ingest_dedupe(tmp_path):
+    files = {name: str(tmp_path / name) for name in ['data.npz', 'meta.pkl', 'top{k}.npz', 'tripples.parquet']}
+    build_vocab.main(str(make_tar(tmp_path / 'in.tar', WORKBOOKS, copies={'e': 'b'})), files['data.npz'], files['meta.pkl'])
+    compare.main(files['data.npz'], files['top{k}.npz'], top_k=3)
+    search.main(files['data.npz'], files['top{k}.npz'].format(k=3), files['tripples.parquet'])
+
+    # b is in the corpus and e was deduplicated, g copies b and h has a copy of the sheet of a
+    new = {'b': WORKBOOKS['b'], 'h': [WORKBOOKS['a'][0], [['new', 'sheet']]]}
+    ingest.main(str(make_tar(tmp_path / 'new.tar', new, copies={'e': 'b', 'g': 'b'})), files['data.npz'], files['meta.pkl'],
+                files['top{k}.npz'], files['tripples.parquet'], top_k=3)
+    vocab, words_member, duplicates = load_meta(files['meta.pkl'])
+    assert words_member == [('a', 0), ('b', 0), ('b', 1), ('c', 0), ('h', 1)]
+    assert duplicates == {('e', 0): 1, ('e', 1): 2, ('g', 0): 1, ('g', 1): 2, ('h', 0): 0}
+    assert load_npz(files['data.npz']).shape[0] == 5
+
+
+def test_sample(tmp_path):
+    names = [f'cc-binaries/{n}.xls' for n in range(10_000)]
+    picked = [n for n in names if sample.in_sample(n, 0.1)]
+    assert 900 < len(picked) < 1100
+    assert picked == [n for n in names if sample.in_sample(n.split('/')[-1], 0.1)]
+    assert all(sample.in_sample(n, None) and sample.in_sample(n, 1) for n in names[:10])
+
+    workbooks = {f'w{n}': [[['w', str(n)], ['x', 'y']]] for n in range(20)}
+    tar = make_tar(tmp_path / 'in.tar', workbooks)
+    with tarfile.open(tar) as t:
+        _, words_member, _, _ = build_vocab.load_from_tar(t, sample_rate=0.5)
+    os.makedirs(tmp_path / 'tall')
+    with tarfile.open(tar) as t:
+        _, extracted, _, _ = extract.extract(t, str(tmp_path / 'tall'), sample_rate=0.5)
+    expected = [f'cc-binaries/w{n}' for n in range(20) if sample.in_sample(f'w{n}', 0.5)]
+    assert [m.name for m, _ in words_member] == [m.name for m, _ in extracted] == expected
+
+
+def test_verify(tmp_path):
+    os.makedirs(tmp_path / 'tall')
+    sheets = concat_sheets()
+    # Sheet 6 is sheet 4 and sheet 2 moved apart
+    sheets[6] = np.zeros((6, 7), dtype=int)
+    sheets[6][:3, :2] = sheets[4]
+    sheets[6][4:, 3:] = sheets[2]
+    tall_frame(sheets).to_parquet(tmp_path / 'tall' / 'df_0000.parquet')
+    tripples = pd.DataFrame({'i': [0, 3, 5, 6, 0], 'j': [2, 1, 1, 2, 1], 'k': [1, 4, 2, 4, 5], 'score': [5., 4., 3., 2., 1.]})
+    tripples.to_parquet(tmp_path / 'tripples.parquet')
+    counts = verify.main(str(tmp_path / 'tripples.parquet'), str(tmp_path / 'tall'), str(tmp_path / 'verified.parquet'),
+                         batch_size=2, n_jobs=2, chunk_size=3)
+    df = pd.read_parquet(tmp_path / 'verified.parquet')
+    assert counts.to_dict() == {'none': 2, 'vconcat': 1, 'hconcat': 1, 'move': 1}
+    assert df.category.tolist() == ['vconcat', 'hconcat', 'none', 'move', 'none']
+    assert df.order.fillna('').tolist() == ['cb', 'bc', '', 'bc', '']
+    assert df.exact.tolist() == [True, True, False, True, False]
+    assert df.score.tolist() == [5., 4., 3., 2., 1.]
+    # The best two, from a file that is not sorted
+    tripples.iloc[::-1].to_parquet(tmp_path / 'reversed.parquet')
+    verify.main(str(tmp_path / 'reversed.parquet'), str(tmp_path / 'tall'), str(tmp_path / 'verified.parquet'), top_n=2, n_jobs=1)
+    assert pd.read_parquet(tmp_path / 'verified.parquet').category.tolist() == ['vconcat', 'hconcat']
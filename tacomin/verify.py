@@ -0,0 +1,162 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from tabia.operations import concat_align_tops, concat_horizontally, concat_vertically, move
+from tabia.table import Table
+
+from .collect import TopCollector
+from .index import tall_source
+
+# Reconstructions of A from (B, C), tried in this order; both orders of B and C are tried
+RECONSTRUCTIONS = {
+    'vconcat': lambda b, c, offsets: concat_vertically(b, c),
+    'hconcat': lambda b, c, offsets: concat_horizontally(b, c),
+    'align_tops': lambda b, c, offsets: concat_align_tops(b, c),
+    'move': lambda b, c, offsets: move(b, *offsets[0]) + move(c, *offsets[1]),
+}
+
+
+def load_cells(parquet_tall_dir, fs):
+    """The (fs, i, j, v) cells of the sheets fs, from the tall parquet."""
+    con = duckdb.connect(config={'threads': 1})
+    fs_df = pd.DataFrame({'fs': np.unique(fs).astype(np.int32)})
+    cells = con.sql(f"""
+    select fs, cast(i as int) as i, cast(j as int) as j, v
+    from {tall_source(parquet_tall_dir, fs_df.fs.to_numpy())}
+    where fs in (select fs from fs_df)
+    """).df()
+    con.close()
+    return {fs: df[['i', 'j', 'v']].reset_index(drop=True) for fs, df in cells.groupby('fs')}
+
+
+def normalise(cells):
+    """The cells as a set of (i, j, v), moved so the top-left cell is at (0, 0)."""
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+    if len(cells) == 0:
+        return set()
+    cells = cells - [cells[:, 0].min(), cells[:, 1].min(), 0]
+    return set(map(tuple, cells.tolist()))
+
+
+def offset(a, b):
+    """The most common offset (di, dj) that moves cells of b onto equal cells of a."""
+    pairs = a.merge(b, on='v', suffixes=('_a', '_b'))
+    if pairs.empty:
+        return 0, 0
+    counts = pd.DataFrame({'di': pairs.i_a - pairs.i_b, 'dj': pairs.j_a - pairs.j_b}).value_counts()
+    return tuple(int(d) for d in counts.index[0])
+
+
+def match(a, cells):
+    """Jaccard similarity of the normalised cell sets of a and a reconstruction."""
+    r = normalise(cells)
+    return len(a & r) / max(len(a | r), 1)
+
+
+def verify_triple(a, b, c, min_coverage=0.9, max_cells=2500):
+    """
+    The best reconstruction of sheet a from sheets b and c, as (category, order, match).
+
+    Before any tabia operation is run, a triple exits early when the values of b and c
+    cover less than min_coverage of the cells of a, since no reconstruction can then reach
+    that match, or when a sheet has more than max_cells cells, as the tabia operations
+    join tables with themselves. Reconstructions whose cell count cannot be that of a are
+    skipped, and the search stops at the first exact reconstruction.
+    """
+    if max(len(a), len(b), len(c)) > max_cells:
+        return 'too_large', None, 0.0
+    coverage = a.v.isin(np.union1d(b.v, c.v)).mean() if len(a) else 0.0
+    if coverage < min_coverage:
+        return 'none', None, coverage
+    target = normalise(a.to_numpy())
+    tables = {'b': Table(b), 'c': Table(c)}
+    offsets = {'b': offset(a, b), 'c': offset(a, c)}
+    best = ('none', None, 0.0)
+    for category, reconstruct in RECONSTRUCTIONS.items():
+        # Apart from a move onto overlapping cells, reconstructions keep every cell of b and c
+        if category != 'move' and len(b) + len(c) != len(a):
+            continue
+        for order in ['bc', 'cb']:
+            first, second = tables[order[0]], tables[order[1]]
+            reconstruction = reconstruct(first, second, (offsets[order[0]], offsets[order[1]]))
+            score = match(target, reconstruction.to_tuples())
+            if score > best[2]:
+                best = (category, order, score)
+            if score == 1.0:
+                return best
+    return best
+
+
+def verify_batch(tripples, parquet_tall_dir, min_coverage=0.9, max_cells=2500):
+    """verify_triple for a frame of (i, j, k) triples, as a frame with category, order and match."""
+    sheets = load_cells(parquet_tall_dir, tripples[['i', 'j', 'k']].to_numpy().ravel())
+    empty = pd.DataFrame({'i': [], 'j': [], 'v': []}, dtype=np.int64)
+    rows = [verify_triple(sheets.get(i, empty), sheets.get(j, empty), sheets.get(k, empty), min_coverage, max_cells)
+            for i, j, k in tripples[['i', 'j', 'k']].itertuples(index=False)]
+    result = tripples[['i', 'j', 'k']].reset_index(drop=True)
+    result[['category', 'order', 'match']] = pd.DataFrame(rows, columns=['category', 'order', 'match'])
+    result['exact'] = result.match == 1.0
+    return result
+
+
+def main(tripples, parquet_tall_dir, output_file, top_n=None, batch_size=100, n_jobs=None, min_coverage=0.9, max_cells=2500,
+         chunk_size=100_000):
+    """
+    Verify triples on a process pool and write the category of each to output_file. With
+    top_n only the best top_n are verified, selected in bounded memory (see TopCollector)
+    and sorted by score; otherwise every triple is verified, in file order. The triples
+    are read and the results written chunk_size triples at a time. Returns the number of
+    triples per category.
+    """
+    t0 = time.time()
+    parquet_file = pq.ParquetFile(tripples)
+    columns = ['i', 'j', 'k', 'score']
+    if top_n is not None:
+        collector = TopCollector(n=top_n)
+        for batch in parquet_file.iter_batches(batch_size=1_000_000, columns=columns):
+            collector.add(batch.to_pandas())
+        df = collector.close()
+        chunks = [df.iloc[s:s + chunk_size] for s in range(0, len(df), chunk_size)] if df is not None else []
+    else:
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns))
+
+    writer = None
+    counts = pd.Series(dtype=np.int64)
+    n_exact = n_total = 0
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        for chunk in chunks:
+            batches = [chunk.iloc[s:s + batch_size] for s in range(0, len(chunk), batch_size)]
+            results = list(tqdm(pool.map(verify_batch, batches, [parquet_tall_dir] * len(batches),
+                                         [min_coverage] * len(batches), [max_cells] * len(batches)), total=len(batches)))
+            if not results:
+                continue
+            result = pd.concat(results, ignore_index=True)
+            result['score'] = chunk.score.to_numpy()
+            table = pa.Table.from_pandas(result, preserve_index=False)
+            if writer is None:
+                # order is all None in a chunk without reconstructions, so the text columns are fixed
+                schema = table.schema
+                for name in ['category', 'order']:
+                    schema = schema.set(schema.get_field_index(name), pa.field(name, pa.string()))
+                writer = pq.ParquetWriter(output_file, schema)
+            writer.write_table(table.cast(writer.schema))
+            counts = counts.add(result.category.value_counts(), fill_value=0).astype(np.int64)
+            n_exact += int(result.exact.sum())
+            n_total += len(result)
+    if writer is None:
+        empty = pd.DataFrame({c: pd.Series(dtype=np.int64) for c in ['i', 'j', 'k']})
+        verify_batch(empty, parquet_tall_dir).assign(score=np.zeros(0)).to_parquet(output_file)
+    else:
+        writer.close()
+    print(counts.to_string())
+    print('Exact', n_exact, 'of', n_total)
+    print('Time taken', time.time() - t0)
+    return counts